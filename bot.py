@@ -1,13 +1,31 @@
-from telegram import Update 
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update 
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, filters
 
 import io
+import csv # Выгрузка и загрузка истории курсов в CSV
+import sys # Аргументы командной строки (python bot.py export/import)
+import argparse
+import bisect # Поиск корзины гистограммы задержек
+import contextvars # Время запросов к API и базе привязывается к обработчику, который их выполняет
+from contextlib import contextmanager
+import tempfile # Временный файл для выгрузки длинной истории сообщений
 import os #модуль позволяет работать с файловой системой, процессами, окружением и другими аспектами операционной системы.
-import psycopg2 # Для работы с базами данных PostgreSQL из Python.
+import psycopg # Для работы с базами данных PostgreSQL из Python (psycopg 3, поддерживает async).
+from psycopg import sql # Для безопасной сборки DDL-запросов (имена секций таблицы rates)
+from psycopg_pool import AsyncConnectionPool # Асинхронный пул соединений с базой данных
+import asyncio # Для фоновых задач в цикле событий
 import datetime # Для работы с датами и временем.
 import logging # Для логирования событий в программ
-import requests # Для выполнения HTTP-запросов
-import matplotlib.pyplot as plt # Для визуализации данных
+import httpx # Асинхронный HTTP-клиент для запросов к API (не блокирует цикл событий бота)
+import time # Для измерения интервалов (ограничение частоты запросов)
+import uuid # Идентификатор экземпляра бота (реплики)
+import numpy as np # Для векторных вычислений статистики курсов
+from matplotlib.figure import Figure # Для визуализации данных (объектный API без глобального состояния pyplot)
+from matplotlib.backends.backend_agg import FigureCanvasAgg # Рисование графика в PNG без графического интерфейса
+from concurrent.futures import ProcessPoolExecutor # Пул процессов для рисования графиков вне цикла событий
+import multiprocessing # Способ запуска процессов пула (spawn)
+from collections import OrderedDict # Словарь с порядком элементов (для вытеснения давно не использованных графиков)
 from functools import wraps
 
 
@@ -35,69 +53,934 @@ API_KEY = os.getenv("API_KEY") # Ключ API для получения курс
 #Переменные окружения (os.getenv): Используются для безопасного хранения конфиденциальной информации (токенов и ключей).
 #переменная окружения API_KEY хранит токен API, который используется в коде, но сам токен не хранится прямо в исходном коде.
 
+# Настройки загрузки исторических курсов
+API_URL = os.getenv("API_URL", "https://openexchangerates.org/api") # Адрес API, можно подменить на локальный сервер-заглушку для тестов
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "4")) # Сколько дней загружается одновременно
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", "5")) # Не больше стольких запросов к API в секунду (по квоте тарифа), 0 - без ограничения
+API_RATE_BURST = int(os.getenv("API_RATE_BURST", "5")) # Сколько запросов можно сделать подряд без ожидания
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3")) # Сколько раз повторять неудачный запрос
+API_RETRY_DELAY = float(os.getenv("API_RETRY_DELAY", "1")) # Пауза перед первым повтором (сек), дальше удваивается
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", "10")) # Таймаут HTTP-запроса (сек)
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5")) # Таймаут установки соединения с API (сек)
+API_MAX_CONNECTIONS = int(os.getenv("API_MAX_CONNECTIONS", "10")) # Сколько соединений с API держать в пуле (keep-alive)
+API_HTTP2 = os.getenv("API_HTTP2", "1") == "1" # Использовать HTTP/2, если сервер его поддерживает
+RATES_CACHE_TTL = float(os.getenv("RATES_CACHE_TTL", "600")) # Сколько секунд считать последние курсы свежими (API обновляет их раз в час)
+INGEST_INTERVAL = int(os.getenv("INGEST_INTERVAL", "3600")) # Как часто (сек) фоновая задача загружает последние курсы, 0 - выключено
+INGEST_KEEP_DAYS = int(os.getenv("INGEST_KEEP_DAYS", "30")) # За сколько последних дней фоновая задача поддерживает курсы без пропусков
+INGEST_CATCHUP_MAX_DAYS = int(os.getenv("INGEST_CATCHUP_MAX_DAYS", "365")) # Насколько далеко назад догружать дни, пропущенные пока бот был выключен
+PLOT_WORKERS = int(os.getenv("PLOT_WORKERS", "2")) # Сколько процессов рисуют графики одновременно
+PLOT_MAX_POINTS = int(os.getenv("PLOT_MAX_POINTS", "300")) # Сколько точек на валюту максимум рисовать на графике /plot
+CHART_CACHE_MAX_BYTES = int(os.getenv("CHART_CACHE_MAX_BYTES", str(20 * 1024 * 1024))) # Сколько байт готовых графиков держать в памяти
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "2")) # Не чаще чем раз в столько секунд обновлять сообщение с прогрессом
+PROGRESS_MIN_STEP = float(os.getenv("PROGRESS_MIN_STEP", "5")) # Обновлять прогресс, только если он вырос хотя бы на столько процентов
+
+# Настройки пула соединений с базой данных
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1")) # Сколько соединений держать открытыми всегда
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10")) # Максимум одновременных соединений
+DB_POOL_STATS_INTERVAL = int(os.getenv("DB_POOL_STATS_INTERVAL", "300")) # Как часто (сек) писать статистику пула и очереди сообщений в лог, 0 - не писать
+
+# Настройки пакетной записи сообщений (echo)
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "100")) # Сколько сообщений записывать в базу за раз
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "1")) # Максимальная задержка записи сообщения (сек)
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000")) # Сколько сообщений может ждать записи; при переполнении обработчик ждёт
+MESSAGE_FLUSH_RETRIES = int(os.getenv("MESSAGE_FLUSH_RETRIES", "3")) # Сколько раз повторять неудачную запись пачки, прежде чем её отбросить
+MESSAGE_RETRY_DELAY = float(os.getenv("MESSAGE_RETRY_DELAY", "0.5")) # Пауза перед первым повтором записи (сек), дальше удваивается
+MESSAGES_PAGE_SIZE = int(os.getenv("MESSAGES_PAGE_SIZE", "50")) # Сколько сообщений показывать на одной странице /return_all_messages
+MESSAGES_BULK_BATCH_SIZE = int(os.getenv("MESSAGES_BULK_BATCH_SIZE", "5000")) # Сколько сообщений удалять/обновлять за одну транзакцию
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "50000")) # Сколько строк курсов читать из базы и записывать в файл за раз при выгрузке
+
+# Настройки метрик
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1") # Адрес HTTP-эндпоинта метрик в формате Prometheus
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108")) # Порт эндпоинта метрик, 0 - выключен
+
+# Настройки получения обновлений от Telegram
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") # Публичный адрес бота (https://...); если не задан, бот получает обновления через polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram") # Путь вебхука: Telegram присылает обновления на WEBHOOK_URL/WEBHOOK_PATH
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0") # Адрес и порт локального HTTP-сервера вебхука (TLS - на балансировщике перед ним)
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None # Секрет в заголовке X-Telegram-Bot-Api-Secret-Token: запросы без него отклоняются
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot") # Адрес Bot API (локальный сервер Bot API или заглушка для нагрузочного теста)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32")) # Сколько обновлений обрабатывается одновременно, 1 - по одному
+UPDATES_QUEUE_SIZE = int(os.getenv("UPDATES_QUEUE_SIZE", "1000")) # Сколько обновлений может ждать своей очереди в чатах
+
+# Идентификатор этого экземпляра бота. Реплики, работающие с одной базой, по нему отличают свои уведомления от чужих
+INSTANCE_ID = uuid.uuid4().hex
+
+# Границы корзин гистограмм задержек (сек)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Части времени обработчика, которые измеряются отдельно: запросы к API курсов, к базе данных и рисование графиков
+METRICS_PHASES = ("api", "db", "render")
+
+class Histogram:
+    """
+    Гистограмма задержек с фиксированными корзинами (как histogram в Prometheus)
+    """
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # последняя корзина - больше самой большой границы (+Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Функция возвращает верхнюю границу корзины, в которую попадает квантиль q (inf, если он больше всех границ)
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """
+    Метрики обработчиков: гистограммы задержек (всего и по частям - api, db, render) и количество ошибок
+    """
+    def __init__(self):
+        self.latency = {} # (обработчик, часть) -> Histogram
+        self.errors = {} # обработчик -> количество ошибок
+
+    def observe(self, handler: str, phase: str, seconds: float) -> None:
+        histogram = self.latency.get((handler, phase))
+        if histogram is None:
+            histogram = self.latency[(handler, phase)] = Histogram()
+        histogram.observe(seconds)
+
+    def error(self, handler: str) -> None:
+        self.errors[handler] = self.errors.get(handler, 0) + 1
+
+    def prometheus(self) -> str:
+        """
+        Функция возвращает метрики в текстовом формате Prometheus
+        """
+        lines = ["# HELP bot_handler_duration_seconds Время выполнения обработчика: total - всего, api/db/render - его части",
+                 "# TYPE bot_handler_duration_seconds histogram"]
+        for (handler, phase), histogram in sorted(self.latency.items()):
+            labels = f'handler="{handler}",phase="{phase}"'
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'bot_handler_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"bot_handler_duration_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"bot_handler_duration_seconds_count{{{labels}}} {histogram.count}")
+        lines += ["# HELP bot_handler_errors_total Количество ошибок в обработчике",
+                  "# TYPE bot_handler_errors_total counter"]
+        lines += [f'bot_handler_errors_total{{handler="{handler}"}} {count}' for handler, count in sorted(self.errors.items())]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """
+        Функция возвращает краткую сводку по обработчикам для команды /metrics
+        """
+        lines = []
+        handlers = sorted({handler for handler, _ in self.latency}, key=lambda handler: -self.latency[(handler, "total")].count)
+        for handler in handlers:
+            total = self.latency[(handler, "total")]
+            parts = []
+            for phase in METRICS_PHASES:
+                histogram = self.latency.get((handler, phase))
+                if histogram:
+                    parts.append(f"{phase} {histogram.sum / total.count * 1000:.1f}")
+            lines.append(f"{handler}: {total.count} вызовов, ошибок {self.errors.get(handler, 0)}, "
+                         f"p50 ≤ {total.quantile(0.5):g} с, p95 ≤ {total.quantile(0.95):g} с, "
+                         f"в среднем {total.sum / total.count * 1000:.1f} мс" + (f" ({', '.join(parts)} мс)" if parts else ""))
+        return "\n".join(lines) or "Метрик пока нет"
+
+# Метрики всего процесса. Время запросов к API и базе собирается далеко от обработчика (в клиенте API, в курсоре),
+#поэтому текущий обработчик и его счётчики времени передаются через contextvars, а не через context.bot_data
+METRICS = Metrics()
+# {"handler": имя, "api": сек, "db": сек, "render": сек, "active": {часть: [сколько вызовов идёт, когда начался первый]}}
+METRICS_TIMINGS = contextvars.ContextVar("metrics_timings", default=None)
+
+@contextmanager
+def track(phase: str):
+    """
+    Функция добавляет время выполнения блока with к части phase (api, db, render) текущего обработчика.
+    Задачи, запущенные обработчиком (например, параллельные загрузки дней в backfill_rates), пишут в те же счётчики,
+    поэтому одновременные вызовы учитываются один раз - от начала первого до конца последнего, и часть не превышает
+    общего времени обработчика
+    """
+    timings = METRICS_TIMINGS.get()
+    if timings is None: # вне обработчика (например, при записи сообщений в фоне) не измеряем
+        yield
+        return
+    active = timings["active"].setdefault(phase, [0, 0.0])
+    if not active[0]:
+        active[1] = time.perf_counter()
+    active[0] += 1
+    try:
+        yield
+    finally:
+        active[0] -= 1
+        if not active[0]:
+            timings[phase] += time.perf_counter() - active[1]
+
+def measure(func):
+    """
+    Декоратор для обработчиков и задач: измеряет время выполнения и его части (api, db, render), считает ошибки
+    """
+    handler = func.__name__
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        timings = {"handler": handler, "api": 0.0, "db": 0.0, "render": 0.0, "active": {}}
+        token = METRICS_TIMINGS.set(timings)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            METRICS.error(handler) # необработанная ошибка; обработанные считает MetricsErrorHandler
+            raise
+        finally:
+            METRICS.observe(handler, "total", time.perf_counter() - started)
+            for phase in METRICS_PHASES:
+                if timings[phase]:
+                    METRICS.observe(handler, phase, timings[phase])
+            METRICS_TIMINGS.reset(token)
+    return wrapper
+
+class MetricsErrorHandler(logging.Handler):
+    """
+    Считает ошибки, которые обработчики перехватили сами и записали в лог через logging.error
+    """
+    def emit(self, record: logging.LogRecord) -> None:
+        timings = METRICS_TIMINGS.get()
+        if timings is not None:
+            METRICS.error(timings["handler"])
+
+logging.getLogger().addHandler(MetricsErrorHandler(level=logging.ERROR))
+
+def timed_method(phase: str, method):
+    """
+    Функция оборачивает async-метод так, чтобы его время добавлялось к части phase текущего обработчика
+    """
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        with track(phase):
+            return await method(self, *args, **kwargs)
+    return wrapper
+
+class TimedCursor(psycopg.AsyncCursor):
+    """
+    Курсор, который учитывает время запросов к базе в метриках обработчика
+    """
+    execute = timed_method("db", psycopg.AsyncCursor.execute)
+    executemany = timed_method("db", psycopg.AsyncCursor.executemany)
+    fetchone = timed_method("db", psycopg.AsyncCursor.fetchone)
+    fetchmany = timed_method("db", psycopg.AsyncCursor.fetchmany)
+    fetchall = timed_method("db", psycopg.AsyncCursor.fetchall)
+
+class TimedServerCursor(psycopg.AsyncServerCursor):
+    """
+    Серверный (именованный) курсор, который учитывает время запросов к базе в метриках обработчика
+    """
+    execute = timed_method("db", psycopg.AsyncServerCursor.execute)
+    fetchone = timed_method("db", psycopg.AsyncServerCursor.fetchone)
+    fetchmany = timed_method("db", psycopg.AsyncServerCursor.fetchmany)
+    fetchall = timed_method("db", psycopg.AsyncServerCursor.fetchall)
+
+async def configure_connection(conn: psycopg.AsyncConnection) -> None:
+    """
+    Функция настраивает новое соединение пула: курсоры с измерением времени запросов
+    """
+    conn.cursor_factory = TimedCursor
+    conn.server_cursor_factory = TimedServerCursor
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """
+    Минимальный HTTP-сервер метрик: на любой GET отвечает метриками в формате Prometheus
+    """
+    try:
+        await reader.readline() # строка запроса; путь не важен
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""): # заголовки
+            pass
+        body = METRICS.prometheus().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+# Пул создаётся один раз в main() и хранится в application.bot_data, обработчики берут его через context.bot_data.
+#Так соединение не открывается заново на каждое сообщение и не блокирует цикл событий бота.
+def get_pool(context: ContextTypes.DEFAULT_TYPE) -> AsyncConnectionPool:
+    """
+    Функция возвращает общий пул соединений с базой данных
+    """
+    return context.bot_data["db_pool"]
+
+def pool_stats(pool: AsyncConnectionPool) -> dict:
+    """
+    Функция собирает статистику пула: занятые соединения, ожидающие запросы и среднее время получения соединения
+    """
+    stats = pool.get_stats() # счётчики requests_* обнуляются только через pop_stats()
+    size = stats.get("pool_size", 0)
+    available = stats.get("pool_available", 0)
+    requests_num = stats.get("requests_num", 0)
+    wait_ms = stats.get("requests_wait_ms", 0)
+    return {
+        "size": size,
+        "in_use": size - available,
+        "waiting": stats.get("requests_waiting", 0),
+        "requests": requests_num,
+        "avg_acquire_ms": round(wait_ms / requests_num, 2) if requests_num else 0.0,
+        "errors": stats.get("requests_errors", 0),
+    }
+
+async def log_pool_stats(application) -> None:
+    """
+    Функция периодически пишет статистику пула и очереди записи сообщений в лог
+    """
+    while True:
+        await asyncio.sleep(DB_POOL_STATS_INTERVAL)
+        logging.info(f"Статистика пула БД: {pool_stats(application.bot_data['db_pool'])}")
+        logging.info(f"Статистика записи сообщений: {application.bot_data['message_writer'].stats()}")
+
+async def open_pool(application) -> None:
+    """
+    Функция открывает пул соединений после запуска цикла событий (post_init)
+    """
+    pool = application.bot_data["db_pool"]
+    await pool.open(wait=True)
+    if DB_POOL_STATS_INTERVAL > 0:
+        application.bot_data["db_pool_stats_task"] = asyncio.create_task(log_pool_stats(application))
+
+async def close_pool(application) -> None:
+    """
+    Функция закрывает пул соединений при остановке бота (post_shutdown)
+    """
+    task = application.bot_data.pop("db_pool_stats_task", None)
+    if task:
+        task.cancel()
+    pool = application.bot_data["db_pool"]
+    logging.info(f"Статистика пула БД: {pool_stats(pool)}")
+    await pool.close()
+
+async def on_startup(application) -> None:
+    """
+    Функция выполняется после запуска цикла событий (post_init): открывает общие ресурсы бота
+    """
+    await open_pool(application)
+    application.bot_data["message_writer"].start()
+    application.bot_data["rates_subscriber"].start()
+    if METRICS_PORT > 0:
+        application.bot_data["metrics_server"] = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def on_shutdown(application) -> None:
+    """
+    Функция выполняется при остановке бота (post_shutdown): освобождает общие ресурсы
+    """
+    server = application.bot_data.pop("metrics_server", None)
+    if server:
+        server.close()
+        await server.wait_closed()
+    await application.bot_data["rates_subscriber"].stop()
+    application.bot_data["plot_executor"].shutdown(wait=True)
+    await application.bot_data["rates_api"].close()
+    # Дописываем в базу сообщения, которые ещё ждут в очереди, пока пул соединений открыт
+    await application.bot_data["message_writer"].stop()
+    await close_pool(application)
+
+# Новые коды валют добавляются в справочник currencies. NOT EXISTS не даёт тратить значения последовательности id (smallint)
+#на уже известные валюты, ON CONFLICT защищает от одновременной вставки той же валюты
+STORE_CURRENCIES_QUERY = """
+    INSERT INTO currencies (code)
+    SELECT t.code FROM unnest(%s::text[]) AS t(code)
+    WHERE NOT EXISTS (SELECT 1 FROM currencies c WHERE c.code = t.code)
+    ON CONFLICT (code) DO NOTHING
+"""
+
+# Запрос для пакетной записи курсов за один день: все валюты передаются двумя массивами и разворачиваются через unnest,
+#поэтому на весь снимок (~170 валют) уходит один запрос к базе вместо отдельного INSERT на каждую валюту.
+#Коды валют заменяются на их id из справочника currencies.
+STORE_RATES_QUERY = """
+    INSERT INTO rates (date, base_id, currency_id, rate)
+    SELECT %(date)s, b.id, c.id, t.rate
+    FROM unnest(%(currencies)s::text[], %(rates)s::float8[]) AS t(currency, rate)
+    JOIN currencies c ON c.code = t.currency
+    JOIN currencies b ON b.code = %(base)s
+    ON CONFLICT (base_id, currency_id, date) DO UPDATE
+       SET rate = EXCLUDED.rate,
+           updated_at = now()
+"""
+
+# Пересчёт месячных агрегатов rate_stats_monthly для валют снимка. Пересчитываются только месяц записанного дня и следующий за ним:
+#дневное изменение первого дня следующего месяца зависит от курса записанного дня. LAG берёт курс предыдущего дня в базе (ищем до 31 дня назад).
+REFRESH_STATS_QUERY = """
+    INSERT INTO rate_stats_monthly (base_currency, currency, month, days, rate_sum, rate_sq_sum, rate_min, rate_max,
+                                    change_count, change_sum, change_sq_sum)
+    SELECT base_currency, currency, date_trunc('month', date)::date,
+           COUNT(*), SUM(rate), SUM(rate * rate), MIN(rate), MAX(rate),
+           COUNT(change), COALESCE(SUM(change), 0), COALESCE(SUM(change * change), 0)
+    FROM (
+        SELECT %(base)s AS base_currency, c.code AS currency, r.date, r.rate,
+               (r.rate / LAG(r.rate) OVER (PARTITION BY r.currency_id ORDER BY r.date) - 1) * 100 AS change
+        FROM rates r
+        JOIN currencies c ON c.id = r.currency_id
+        WHERE r.base_id = (SELECT id FROM currencies WHERE code = %(base)s)
+          AND r.currency_id = ANY(ARRAY(SELECT id FROM currencies WHERE code = ANY(%(currencies)s)))
+          AND r.date >= %(from)s::date - 31 AND r.date < %(to)s
+    ) AS t
+    WHERE date >= %(from)s
+    GROUP BY base_currency, currency, date_trunc('month', date)
+    ORDER BY base_currency, currency, date_trunc('month', date)
+    ON CONFLICT (base_currency, currency, month) DO UPDATE
+       SET days = EXCLUDED.days, rate_sum = EXCLUDED.rate_sum, rate_sq_sum = EXCLUDED.rate_sq_sum,
+           rate_min = EXCLUDED.rate_min, rate_max = EXCLUDED.rate_max, change_count = EXCLUDED.change_count,
+           change_sum = EXCLUDED.change_sum, change_sq_sum = EXCLUDED.change_sq_sum
+"""
+
+# Пересчёты агрегатов выполняются по очереди. Каждый пересчёт читает курсы из снимка своей транзакции: без блокировки две одновременные
+#записи разных дней одного месяца не видят день друг друга, и записанный позже агрегат теряет чужой день. Блокировка берётся перед
+#REFRESH_STATS_QUERY и держится до commit, поэтому следующий пересчёт (его снимок берётся уже после блокировки) видит записанные курсы
+STATS_LOCK_QUERY = "SELECT pg_advisory_xact_lock(hashtext('rate_stats'));"
+
+def month_start(date: datetime.date) -> datetime.date:
+    return date.replace(day=1)
+
+def next_month(date: datetime.date) -> datetime.date:
+    return (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+# Функции, которые вызываются после записи курсов в базу: listener(base_currency, date, rates).
+#Через них кэши (например, кэш графиков) узнают, что данные по валютам изменились. Регистрируются в main().
+RATES_STORED_LISTENERS = []
+
+# Годы, для которых секция таблицы rates уже создана (или проверена) в этом процессе
+RATES_PARTITIONS = set()
+
+def rates_partition_query(year: int) -> sql.Composed:
+    """
+    Функция возвращает запрос, создающий секцию таблицы rates за год, если её ещё нет
+    """
+    return sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF rates FOR VALUES FROM ({}) TO ({});").format(
+        sql.Identifier(f"rates_{year}"), sql.Literal(datetime.date(year, 1, 1)), sql.Literal(datetime.date(year + 1, 1, 1)))
+
+async def ensure_rates_partition(pool: AsyncConnectionPool, year: int) -> None:
+    """
+    Функция создаёт секцию таблицы rates за год перед первой записью в неё.
+    Создание секции блокирует всю таблицу rates, поэтому идёт отдельной короткой транзакцией
+    """
+    if year in RATES_PARTITIONS:
+        return
+    async with pool.connection() as conn:
+        # Одновременные загрузки (фоновая и /get_historical_rates) создают секцию по очереди
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('rates_partitions'));")
+        await conn.execute(rates_partition_query(year))
+        await conn.commit()
+    RATES_PARTITIONS.add(year)
+
+async def store_rates(pool: AsyncConnectionPool, base_currency: str, date: datetime.date, rates: dict) -> int:
+    """
+    Функция сохраняет курсы всех валют за один день одним запросом и возвращает количество записанных строк
+    """
+    # В ответе API целые курсы приходят числами int ("USD": 1, "BMD": 1), а psycopg не передаёт массив из int и float вместе -
+    #приводим все курсы к float; валюты без курса (None) не записываем
+    rates = {currency: float(rate) for currency, rate in rates.items() if rate is not None}
+    if not rates:
+        return 0
+    currencies = list(rates.keys())
+    values = [rates[currency] for currency in currencies]
+    await ensure_rates_partition(pool, date.year)
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(STORE_CURRENCIES_QUERY, ([base_currency] + currencies,))
+            await cursor.execute(STORE_RATES_QUERY, {"base": base_currency, "date": date, "currencies": currencies, "rates": values})
+            stored = cursor.rowcount
+            # В той же транзакции обновляем статистику (/stats) только за затронутые месяцы
+            await cursor.execute(STATS_LOCK_QUERY)
+            await cursor.execute(REFRESH_STATS_QUERY, {"base": base_currency, "currencies": currencies,
+                                                       "from": month_start(date), "to": next_month(next_month(date))})
+            # Другие экземпляры бота узнают о новых курсах из уведомления (доставляется после commit), см. RatesStoredSubscriber
+            await cursor.execute("SELECT pg_notify('rates_stored', %s);", (f"{INSTANCE_ID} {base_currency} {date}",))
+        await conn.commit()
+    for listener in RATES_STORED_LISTENERS:
+        listener(base_currency, date, rates)
+    return stored
+
+# Курсы всех валют за один день
+DAY_RATES_QUERY = """
+    SELECT c.code, r.rate
+    FROM rates r
+    JOIN currencies c ON c.id = r.currency_id
+    WHERE r.base_id = (SELECT id FROM currencies WHERE code = %(base)s)
+      AND r.date = %(date)s;
+"""
+
+class RatesStoredSubscriber:
+    """
+    Подписка на уведомления о записи курсов (LISTEN rates_stored). Когда курсы записывает другой экземпляр бота
+    (реплика за тем же вебхуком), кэши этого экземпляра обновляются так же, как после собственной записи в store_rates.
+    Уведомления, пришедшие пока соединение было разорвано, теряются
+    """
+    def __init__(self, url: str, pool: AsyncConnectionPool, retry_delay: float = 5):
+        self.url = url
+        self.pool = pool
+        self.retry_delay = retry_delay
+        self.task = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # Отдельное соединение вне пула: оно всё время ждёт уведомлений
+                async with await psycopg.AsyncConnection.connect(self.url, autocommit=True) as conn:
+                    await conn.execute("LISTEN rates_stored;")
+                    async for notify in conn.notifies():
+                        await self._apply(notify.payload)
+            except Exception as e:
+                logging.error(f"Подписка на новые курсы прервана: {e}")
+                await asyncio.sleep(self.retry_delay)
+
+    async def _apply(self, payload: str) -> None:
+        instance, base_currency, date = payload.split()
+        if instance == INSTANCE_ID: # свои записи store_rates уже передал в кэши
+            return
+        date = datetime.date.fromisoformat(date)
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(DAY_RATES_QUERY, {"base": base_currency, "date": date})
+                rates = dict(await cursor.fetchall())
+        for listener in RATES_STORED_LISTENERS:
+            listener(base_currency, date, rates)
+
+class RatesAPIError(Exception):
+    """
+    Ошибка запроса к API курсов валют (код ответа или описание сетевой ошибки)
+    """
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов «ведро с токенами»: в среднем не больше rate запросов в секунду, подряд - не больше capacity
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0: # ограничение выключено
+            return
+        async with self.lock: # ожидающие запросы получают токены по очереди
+            while True:
+                now = time.monotonic()
+                # Пополняем ведро пропорционально прошедшему времени
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ExchangeRatesClient:
+    """
+    Клиент API OpenExchangeRates. Один на всё приложение: создаётся при запуске и закрывается при остановке бота.
+    Соединения переиспользуются (keep-alive, HTTP/2), а все запросы проходят через общий ограничитель частоты.
+    В тестах его можно подменить в bot_data["rates_api"], чтобы работать без настоящего API.
+    """
+    def __init__(self, app_id: str, base_url: str, timeout: float, connect_timeout: float, max_connections: int,
+                 http2: bool, limiter: TokenBucket):
+        self.app_id = app_id
+        self.limiter = limiter
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            http2=http2,
+        )
+
+    async def latest(self, base: str = None, symbols: str = None, etag: str = None, last_modified: str = None) -> httpx.Response:
+        """
+        Функция запрашивает последние курсы; etag и last_modified делают запрос условным (ответ 304, если данные не изменились)
+        """
+        params = {'app_id': self.app_id}
+        if base:
+            params['base'] = base
+        if symbols:
+            params['symbols'] = symbols
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        await self.limiter.acquire()
+        with track("api"):
+            return await self.client.get("/latest.json", params=params, headers=headers)
+
+    async def historical(self, day: datetime.date) -> httpx.Response:
+        """
+        Функция запрашивает курсы за прошедший день
+        """
+        await self.limiter.acquire()
+        with track("api"):
+            return await self.client.get(f"/historical/{day}.json", params={'app_id': self.app_id})
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+class LatestRatesCache:
+    """
+    Кэш последних курсов (latest.json) с временем жизни.
+    Одновременные запросы с одним ключом ждут одну общую загрузку, а устаревшая запись перепроверяется
+    условным запросом (ETag / Last-Modified), чтобы не скачивать те же данные заново.
+    """
+    def __init__(self, api: ExchangeRatesClient, ttl: float):
+        self.api = api
+        self.ttl = ttl
+        self.entries = {} # (base, symbols) -> {"data", "text", "etag", "last_modified", "expires", "stored"}
+        self.inflight = {} # (base, symbols) -> задача загрузки, которую ждут все одновременные запросы
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.not_modified = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "not_modified": self.not_modified}
+
+    async def get(self, base: str = None, symbols: str = None) -> dict:
+        """
+        Функция возвращает запись кэша с курсами, при необходимости загружая их из API
+        """
+        key = (base, symbols)
+        entry = self.entries.get(key)
+        if entry and entry["expires"] > time.monotonic():
+            self.hits += 1
+            return entry
+        task = self.inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._fetch(key, entry))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # shield: если один из ожидающих отменён, общая загрузка для остальных продолжается.
+        #Ожидание общей загрузки - это время API для каждого ожидающего, а не только для того, кто её запустил
+        with track("api"):
+            return await asyncio.shield(task)
+
+    async def _fetch(self, key: tuple, entry: dict) -> dict:
+        base, symbols = key
+        response = await self.api.latest(base, symbols,
+                                         etag=entry["etag"] if entry else None,
+                                         last_modified=entry["last_modified"] if entry else None)
+        if response.status_code == 304 and entry:
+            # Данные не изменились - продлеваем срок жизни старой записи
+            self.not_modified += 1
+            entry["expires"] = time.monotonic() + self.ttl
+            return entry
+        if response.status_code != 200:
+            raise RatesAPIError(response.status_code)
+        data = response.json()
+        new_entry = {
+            "data": data,
+            "text": response.text,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "expires": time.monotonic() + self.ttl,
+            # Снимок с той же временной меткой уже записан в базу - повторно не сохраняем
+            "stored": bool(entry and entry["stored"] and entry["data"].get("timestamp") == data.get("timestamp")),
+        }
+        self.entries[key] = new_entry
+        logging.info(f"Кэш последних курсов обновлён: {self.stats()}")
+        return new_entry
+
+def snapshot_date(timestamp: int) -> datetime.date:
+    """
+    Функция возвращает дату снимка курсов по его временной метке. Дни в API (historical/ГГГГ-ММ-ДД.json) и в базе считаются в UTC,
+    поэтому дата не должна зависеть от часового пояса сервера
+    """
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date()
+
+async def store_latest_rates(context: ContextTypes.DEFAULT_TYPE, entry: dict) -> bool:
+    """
+    Функция сохраняет в базу снимок последних курсов из кэша, если он ещё не сохранён. Возвращает True, если снимок записан сейчас
+    """
+    if entry["stored"]:
+        return False
+    data = entry["data"]
+    date = snapshot_date(data.get("timestamp"))
+    # Сохраняем весь снимок курсов одним запросом.
+    #ON CONFLICT (base_currency, date, currency) DO UPDATE обновляет курс, если запись за этот день уже есть,
+    #а значения передаются через плейсхолдеры %s — это защищает от SQL-инъекций.
+    #Отмечаем снимок заранее, чтобы одновременные запросы с тем же снимком не записывали его повторно
+    entry["stored"] = True
+    try:
+        await store_rates(get_pool(context), data.get("base"), date, data.get("rates", {}))
+    except Exception:
+        entry["stored"] = False
+        raise
+    return True
+
+# Последний день с курсами к USD раньше даты before. Первичный ключ rates начинается с (base_id, currency_id),
+#поэтому максимум ищется по каждой валюте справочника отдельно (короткий поиск по индексу) вместо просмотра всей таблицы
+LATEST_DATE_QUERY = """
+    SELECT MAX(last.date)
+    FROM currencies c,
+         LATERAL (SELECT MAX(r.date) AS date FROM rates r
+                  WHERE r.base_id = (SELECT id FROM currencies WHERE code = 'USD') AND r.currency_id = c.id
+                    AND r.date < %(before)s) AS last
+"""
+
+async def load_latest_rates(pool: AsyncConnectionPool) -> tuple:
+    """
+    Функция возвращает (дата, [(валюта, курс), ...]) за последний день, сохранённый в базе, или None
+    """
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(f"""
+                SELECT date, currency, rate
+                FROM rates_by_code
+                WHERE base_currency = 'USD'
+                  AND date = ({LATEST_DATE_QUERY})
+                ORDER BY currency;
+            """, {"before": datetime.date.max})
+            rows = await cursor.fetchall()
+    if not rows:
+        return None
+    return rows[0][0], [(currency, rate) for _, currency, rate in rows]
+
 # Асинхронная функция для получения курсов валют и сохранения их в базу данных
 # позволяет программе ожидать завершения асинхронной задачи, прежде чем продолжить выполнение.
 #Это важно, чтобы не блокировать выполнение других задач, если код работает в асинхронном режиме (например, в рамках бота, который должен обрабатывать множество запросов одновременно)
 async def get_rates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None: 
     """
     Функция дает курс валют текущую.
-    """# URL API для получения курсов валют
-    url = 'https://openexchangerates.org/api/latest.json' #?app_id=6325952bd484428489f6aa5cbd05b08b" (В API-запросах параметры часто передаются в URL как ключ-значение пары. Например, в данном случае ключ app_id содержит значение токена, который используется для аутентификации в сервисе API.)
-    # Параметры запроса к API
-    params = {
-        'app_id':API_KEY, #Это словарь Python, в котором хранится параметр app_id и его значение — уникальный API ключ.
-        'base':None, # Базовая валюта (по умолчанию USD, если None).
-        'symbols':None, # Список валют, для которых нужны курсы (если None, то все доступные).
-    }
-    # Выполнение GET-запроса к API.
-    response = requests.get(url, params=params)#params- Не нужно вручную собирать URL-строку, параметры автоматически добавляются к запросу.
+    """
+    if INGEST_INTERVAL > 0:
+        # Последние курсы регулярно загружает фоновая задача, поэтому отвечаем сразу из базы, не обращаясь к API
+        latest = await load_latest_rates(get_pool(context))
+        if latest:
+            date, rates = latest
+            await update.message.reply_text("\n".join(f"{currency}: {rate:.6g}" for currency, rate in rates))
+            await update.message.reply_text(f"Обменные курсы для {len(rates)} валют на {date} (из базы данных)")
+            return
+    # Курсы берутся из кэша: API обновляет их раз в час, поэтому повторные запросы не тратят квоту.
+    #Параметры base и symbols не передаём: базовая валюта по умолчанию USD, курсы - по всем доступным валютам.
+    cache = context.bot_data["rates_cache"]
+    try:
+        entry = await cache.get()
+    except (httpx.HTTPError, RatesAPIError) as e:
+        logging.error(f"Произошла ошибка:{e}")
+        await update.message.reply_text(f"Ошибка при запросе курсов: {e}")
+        return
     # Отправка текста ответа от API в Telegram.
-    await update.message.reply_text(response.text) #reply_text() — это метод, который позволяет боту отправить текстовое сообщение в чат в ответ на полученное сообщение. 
+    await update.message.reply_text(entry["text"]) #reply_text() — это метод, который позволяет боту отправить текстовое сообщение в чат в ответ на полученное сообщение. 
     #В данном случае, это текст, который будет отправлен обратно пользователю. не блокируя остальные процессы бота
-    #response — это объект, полученный в результате HTTP-запроса с использованием библиотеки requests
-    #response.text — это строка, содержащая текстовый ответ от API, который обычно в формате JSON или другом текстовом формате
-    # Парсит ответ от сервера в формат JSON, чтобы можно было легко работать с полученными данными. в Python-словарь
-    data = response.json() 
+    #entry["text"] — это строка, содержащая текстовый ответ от API в формате JSON, а entry["data"] - тот же ответ, разобранный в Python-словарь
+    data = entry["data"]
     # Извлечение курсов валют, базовой валюты и временной метки из ответа.
     rates = data.get("rates",{})
     base_currency = data.get("base")
     timestamp = data.get("timestamp")
-    date= datetime.datetime.fromtimestamp(timestamp).date() # Преобразование временной метки в дату.
-    # Подключение к базе данных PostgreSQL.
-    conn=psycopg2.connect(URL) #то значение этой переменной ( из .env файла) будет содержать такую строку подключения.
-    cursor = conn.cursor()
-    #Курсор — это объект, который позволяет работать с результатами SQL-запросов. 
-    #Он выполняет запросы, получает результаты и управляет транзакциями.
-    # Цикл по всем валютам и их курсам
-    for currency, rate in rates.items():
-        # Выполнение SQL-запроса для вставки или обновления данных. Передаете фактические значения в виде кортежа или списка:
-        cursor.execute("""
-                    insert into rates (base_currency, date, currency, rate)
-                    values (%s,%s,%s,%s) 
-                    on conflict (base_currency, date, currency) do update 
-                       set rate = excluded.rate
-                    """, (base_currency, date, currency, rate))
-     #с использованием механизма ON CONFLICT для обновления данных при наличии дубликатов. Этот фрагмент указывает, что конфликт будет проверяться по тройке столбцов:
-     #base_currency, date и currency. Если в таблице уже существует запись с таким же сочетанием значений для этих столбцов, то происходит конфликт.
-     #PostgreSQL будет обновлять столбец rate в существующей записи значением excluded.rate, т.е. значением, которое пытались вставить.
-     
-     #%s — это плейсхолдер для значений, которые будут переданы позже в запрос. Он не является частью SQL-синтаксиса, а используется для безопасной подстановки значений. 
-     #Защита от SQL-инъекций
-     #Плейсхолдеры заменяются фактическими значениями, переданными в запрос, во время его выполнения.
-
-     # Подтверждение изменений в базе данных.
-    conn.commit()
-    # Закрытие курсора и соединения с базой данных
-    cursor.close()
-    conn.close()
+    date= snapshot_date(timestamp) # Преобразование временной метки в дату (UTC).
+    if not await store_latest_rates(context, entry):
+        # Этот снимок курсов уже записан в базу - лишний запрос не делаем
+        await update.message.reply_text(f"Обменные курсы для {len(rates)} валют за {date} уже есть в базе данных")
+        return
 
      # Отправка сообщения в Telegram о количестве загруженных валют и дате.
     await update.message.reply_text(f"Обменные курсы для {len(rates)} валют загружены в базу данных {date}")
 #форматированная строка (f-строка), которая позволяет вставлять переменные в строку. 
 # Функция len(rates) возвращает количество элементов в словаре rates, который содержит курсы валют.
-#{date} — вставляет дату, которая указывает, когда были загружены данные. Это значение получается из datetime.datetime.fromtimestamp(timestamp).date(),
+#{date} — вставляет дату, которая указывает, когда были загружены данные. Это значение получается из snapshot_date(timestamp),
 # то есть это дата, полученная из временной метки timestamp
 
+async def fetch_historical_day(api: ExchangeRatesClient, day: datetime.date) -> dict:
+    """
+    Функция загружает курсы за один день, повторяя запрос с растущей паузой при ошибках сервера и превышении лимита (429)
+    """
+    error = None
+    for attempt in range(API_MAX_RETRIES + 1):
+        try:
+            response = await api.historical(day)
+        except httpx.HTTPError as e: # сетевая ошибка или таймаут - пробуем ещё раз
+            error = RatesAPIError(f"{type(e).__name__}: {e}")
+        else:
+            if response.status_code == 200:
+                return response.json()
+            error = RatesAPIError(response.status_code)
+            #Остальные 4xx (неверная дата, ключ, тариф) повтор не исправит, а квоту потратит
+            if response.status_code != 429 and response.status_code < 500:
+                break
+        if attempt < API_MAX_RETRIES:
+            await asyncio.sleep(API_RETRY_DELAY * 2 ** attempt)
+    raise error
+
+async def backfill_rates(pool: AsyncConnectionPool, api: ExchangeRatesClient, days: list, on_progress=None, on_error=None) -> int:
+    """
+    Функция параллельно загружает курсы за список дней и сохраняет их в базу по мере готовности.
+    Возвращает количество сохранённых дней.
+
+    on_progress(processed, total, day) - необязательная обычная (не async) функция для отчёта о ходе загрузки, она не должна ждать.
+    on_error(day, error) - необязательная обычная (не async) функция, вызывается для каждого дня, который не удалось скачать; она тоже не должна ждать.
+    """
+    total = len(days)
+    if total == 0:
+        return 0
+    pending = asyncio.Queue() # дни, которые ещё нужно скачать
+    for day in days:
+        pending.put_nowait(day)
+    #Скачанные дни. Очередь ограничена, чтобы загрузчики не убегали далеко вперёд записи в базу
+    downloaded = asyncio.Queue(maxsize=BACKFILL_CONCURRENCY * 2)
+
+    async def fetcher() -> None:
+        while True:
+            try:
+                day = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                data = await fetch_historical_day(api, day)
+            except Exception as e: # ошибку передаём записи, чтобы учесть день и сообщить пользователю
+                await downloaded.put((day, None, e))
+            else:
+                await downloaded.put((day, data, None))
+
+    async def writer() -> int:
+        # Записываем готовые дни, пока остальные ещё скачиваются
+        stored = 0
+        for processed in range(1, total + 1):
+            day, data, error = await downloaded.get()
+            if error is None:
+                # Курсы записываются за запрошенный день: метка времени снимка (около 23:59 UTC) в часовом поясе сервера
+                #может прийтись на следующий день, и тогда запрошенный день навсегда остался бы "пропущенным"
+                await store_rates(pool, data.get("base"), day, data.get("rates", {}))
+                stored += 1
+            elif on_error:
+                on_error(day, error)
+            if on_progress:
+                on_progress(processed, total, day)
+        return stored
+
+    fetchers = [asyncio.create_task(fetcher()) for _ in range(min(BACKFILL_CONCURRENCY, total))]
+    try:
+        return await writer()
+    finally:
+        for task in fetchers: # если запись упала, останавливаем загрузку
+            task.cancel()
+        await asyncio.gather(*fetchers, return_exceptions=True)
+
+# Запрос ищет дни периода, которых нет в базе или которые устарели.
+#generate_series строит все даты периода, а LEFT JOIN ... IS NULL (anti-join) оставляет только отсутствующие.
+#День считается устаревшим, если его курсы последний раз записаны до окончания этого дня (UTC), то есть это ещё не итоговые курсы дня.
+MISSING_DAYS_QUERY = """
+    SELECT d::date
+    FROM generate_series(%(start)s::date, %(end)s::date, interval '1 day') AS d
+    LEFT JOIN (
+        SELECT date, MAX(updated_at) AS updated_at
+        FROM rates
+        WHERE base_id = (SELECT id FROM currencies WHERE code = %(base)s) AND date BETWEEN %(start)s AND %(end)s
+        GROUP BY date
+    ) AS stored ON stored.date = d::date
+    WHERE stored.date IS NULL
+       OR stored.updated_at < (d::date + 1)::timestamp AT TIME ZONE 'UTC'
+    ORDER BY d;
+"""
+
+async def find_missing_days(pool: AsyncConnectionPool, base_currency: str, start_date: datetime.date, end_date: datetime.date) -> list:
+    """
+    Функция одним запросом возвращает дни периода, которые нужно (до)загрузить из API
+    """
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(MISSING_DAYS_QUERY, {"start": start_date, "end": end_date, "base": base_currency})
+            return [row[0] for row in await cursor.fetchall()]
+
+class ProgressReporter:
+    """
+    Отчёт о ходе долгой операции без замедления самой операции. report() только запоминает последнее состояние,
+    а фоновая задача показывает его через render не чаще min_interval секунд и только если прогресс вырос на min_step процентов.
+    Промежуточные состояния, которые не успели показать, пропускаются.
+    """
+    def __init__(self, render, min_interval: float, min_step: float):
+        self.render = render # async render(processed, total, *args)
+        self.min_interval = min_interval
+        self.min_step = min_step
+        self.state = None # последнее ещё не показанное состояние
+        self.changed = asyncio.Event()
+        self.stopped = asyncio.Event()
+        self.task = None
+        self.reported = 0
+        self.rendered = 0
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    def report(self, processed: int, total: int, *args) -> None:
+        """
+        Функция запоминает новое состояние; не ждёт Telegram и не блокирует вызывающего
+        """
+        self.state = (processed, total, *args)
+        self.reported += 1
+        self.changed.set()
+
+    async def stop(self) -> None:
+        """
+        Функция останавливает фоновую задачу (дождавшись уже начатого обновления). Итог операции вызывающий показывает сам,
+        поэтому ещё не показанное состояние отбрасывается
+        """
+        if self.task is None:
+            return
+        self.stopped.set()
+        self.changed.set()
+        await self.task
+        self.task = None
+
+    async def _run(self) -> None:
+        next_render = 0.0 # раньше этого момента (time.monotonic) сообщение не обновляем
+        last_percent = None
+        while True:
+            await self.changed.wait()
+            # Выдерживаем паузу между обновлениями; новые состояния за это время просто заменяют друг друга
+            delay = next_render - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            if self.stopped.is_set():
+                return
+            self.changed.clear()
+            state, self.state = self.state, None
+            processed, total = state[0], state[1]
+            percent = processed * 100 / total
+            if last_percent is not None and processed < total and percent - last_percent < self.min_step:
+                continue
+            try:
+                await self.render(*state)
+                self.rendered += 1
+            except RetryAfter as e: # flood control Telegram - ждём, сколько просят, и показываем уже свежее состояние
+                logging.warning(f"Обновление прогресса отложено Telegram на {e.retry_after} сек")
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else e.retry_after
+                next_render = time.monotonic() + retry_after
+                continue
+            except TelegramError as e: # например, сообщение удалено - сама загрузка от этого не должна падать
+                logging.warning(f"Не удалось обновить прогресс: {e}")
+            next_render = time.monotonic() + self.min_interval
+            last_percent = percent
+
 async def get_historical_rates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Функция загружает исторические курсы валют за указанный период и сохраняет их в базу данных.
@@ -112,7 +995,7 @@ async def get_historical_rates(update: Update, context: ContextTypes.DEFAULT_TYP
         start_date = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
         end_date = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
     except (IndexError, ValueError): #блок, который перехватывает ошибки
-        await update.message.reply_text("Укажите даты в формате: /get_historical_rates YYYY-MM-DD YYYY-MM-DD")
+        await update.message.reply_text("Укажите даты в формате: /get_historical_rates YYYY-MM-DD YYYY-MM-DD [--force]")
         return #Возвращается return, чтобы функция завершилась и не продолжала выполнение, если данные не были получены
 
     # Проверяем корректность диапазона дат
@@ -120,57 +1003,26 @@ async def get_historical_rates(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Дата начала должна быть раньше даты окончания.")
         return
 
-    conn = psycopg2.connect(URL)
-    cursor = conn.cursor()
-
-    total_days = (end_date - start_date).days + 1
-    current_date = start_date
+    # --force загружает весь период заново, иначе берём из API только дни, которых нет в базе или которые устарели
+    force = "--force" in context.args[2:]
+    if force:
+        days = [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    else:
+        days = await find_missing_days(get_pool(context), "USD", start_date, end_date) # все курсы в базе хранятся относительно USD
+    if not days:
+        await update.message.reply_text(f"✅ Все данные за период {start_date} — {end_date} уже есть в базе.")
+        return
+    total_days = len(days)
     #Отправляем начальное сообщение с заглушкой
     progress_message = await update.message.reply_text("⏳ Загрузка данных...")
     # Список эмодзи для анимации
     fancy_frames = ["🌑", "🌒", "🌓", "🌔", "🌕", "🌖", "🌗", "🌘"]
     completed_icon = "🟩"  # Заполненная часть прогресса
     remaining_icon = "⬜️"  # Остаток
-    
-    processed_days = 0
-    while current_date <= end_date:
-        #Формируем строку даты в формате YYYY-MM-DD
-        date_str = current_date.strftime("%Y-%m-%d")
-
-        #Формируем URL для API
-        url = f'https://openexchangerates.org/api/historical/{current_date}.json'
-        params = {
-            'app_id': API_KEY,
-            'base': None,
-            'symbols': None,
-        }
-        #Выполняем запрос
-        response = requests.get(url, params=params)
-        if response.status_code != 200:
-            await update.message.reply_text(f"Ошибка при запросе данных за {current_date}: {response.status_code}")
-            current_date += datetime.timedelta(days=1)
-            continue
-        #Обрабатываем данные
-        data = response.json()
-        rates = data.get("rates", {})
-        base_currency = data.get("base")
-        timestamp = data.get("timestamp")
-        date = datetime.datetime.fromtimestamp(timestamp).date()
-
-        # Сохраняем данные в базу
-        for currency, rate in rates.items():
-            cursor.execute("""
-                INSERT INTO rates (base_currency, date, currency, rate)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (base_currency, date, currency) DO UPDATE
-                   SET rate = EXCLUDED.rate
-            """, (base_currency, date, currency, rate))
 
-        conn.commit()
-        #await update.message.reply_text(f"Курсы валют за {current_date} успешно сохранены.")
-        
-        # Обновляем прогресс
-        processed_days += 1
+    async def show_progress(processed_days: int, total_days: int, day: datetime.date) -> None:
+        #Формируем строку даты в формате YYYY-MM-DD
+        date_str = day.strftime("%Y-%m-%d")
         progress = int((processed_days / total_days) * 100)
         #Формируем прогресс-бар
         progress_bar = f"[{completed_icon * (progress // 10)}{remaining_icon * (10 - progress // 10)}] {progress}%"
@@ -183,20 +1035,380 @@ async def get_historical_rates(update: Update, context: ContextTypes.DEFAULT_TYP
             f"⏳ Загрузка данных...\n{progress_bar}\n{frame} Обрабатываем {date_str}\n"
             f"📅 Осталось дней: {total_days - processed_days}"
         )
-       ##progress_bar = f"[{'#' * (progress // 10)}{'.' * (10 - progress // 10)}] {progress}%"
-        ##await progress_message.edit_text(f"⏳ Загрузка данных...\n{progress_bar}")
-        current_date += datetime.timedelta(days=1)
-
-    cursor.close()
-    conn.close()
-    #await update.message.reply_text(f"Обменные курсы за период {start_date} — {end_date} успешно загружены.")
-    ##await progress_message.edit_text(f"✅ Обменные курсы за период {start_date} — {end_date} успешно загружены.")
-    #Финальное сообщение с фейерверками 🎆
-    fireworks = "🎆✨🎇"
-    await progress_message.edit_text(
-        f"✅ {fireworks} Все данные за период {start_date} — {end_date} успешно загружены! {fireworks}\n"
-        f"Спасибо, что воспользовались ботом!"
-    )
+
+    # Ошибки по дням не отправляются отдельными сообщениями (при неверном ключе или исчерпанной квоте это сотни сообщений
+    #и лимиты Telegram) - они собираются и показываются одним итоговым сообщением
+    failed_days = []
+
+    def collect_error(day: datetime.date, error: Exception) -> None:
+        failed_days.append((day, error))
+
+    # Дни скачиваются параллельно (с ограничением частоты запросов), а готовые сразу записываются в базу.
+    #Сообщение с прогрессом обновляется в фоне и не чаще PROGRESS_MIN_INTERVAL, чтобы не упираться в лимиты Telegram и не тормозить загрузку
+    reporter = ProgressReporter(show_progress, PROGRESS_MIN_INTERVAL, PROGRESS_MIN_STEP)
+    reporter.start()
+    try:
+        stored_days = await backfill_rates(get_pool(context), context.bot_data["rates_api"], days, on_progress=reporter.report, on_error=collect_error)
+    except Exception as e: # например, ошибка записи в базу - загрузка остановлена, но пользователь должен об этом узнать
+        logging.error(f"Произошла ошибка:{e}")
+        text = (f"❌ Загрузка за период {start_date} — {end_date} прервана: {e}\n"
+                f"Уже загруженные дни сохранены, повторите команду, чтобы догрузить остальные.")
+    else:
+        if failed_days:
+            failed_days.sort(key=lambda item: item[0])
+            shown = ", ".join(str(day) for day, _ in failed_days[:5]) + (" ..." if len(failed_days) > 5 else "")
+            text = (f"⚠️ Данные за период {start_date} — {end_date} загружены не полностью\n"
+                    f"📥 Загружено дней из API: {stored_days} из {total_days}\n"
+                    f"Не удалось загрузить дней: {len(failed_days)} ({shown}), ошибка: {failed_days[0][1]}")
+        else:
+            #Финальное сообщение с фейерверками 🎆
+            fireworks = "🎆✨🎇"
+            text = (f"✅ {fireworks} Все данные за период {start_date} — {end_date} успешно загружены! {fireworks}\n"
+                    f"📥 Загружено дней из API: {stored_days} из {(end_date - start_date).days + 1}\n"
+                    f"Спасибо, что воспользовались ботом!")
+    finally:
+        await reporter.stop()
+
+    # Итоговое сообщение заменяет прогресс; если Telegram просит подождать (flood control), ждём и повторяем один раз
+    try:
+        await progress_message.edit_text(text)
+    except RetryAfter as e:
+        retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else e.retry_after
+        await asyncio.sleep(retry_after)
+        await progress_message.edit_text(text)
+async def ingest_rates(context: ContextTypes.DEFAULT_TYPE, catch_up: bool = False) -> None:
+    """
+    Функция фоновой загрузки: сохраняет последние курсы и догружает пропущенные дни за последние INGEST_KEEP_DAYS дней.
+    В режиме catch_up (при запуске бота) догружает и дни, пропущенные пока бот был выключен, но не дальше INGEST_CATCHUP_MAX_DAYS
+    """
+    pool = get_pool(context)
+    # Если экземпляров бота несколько (реплики за одним вебхуком), курсы загружает только один из них.
+    #Блокировка сеансовая и держится на отдельном соединении вне пула (загрузка может идти минуты, а пул нужен для записи курсов);
+    #она снимается, когда это соединение закрывается - в том числе при ошибке
+    async with await psycopg.AsyncConnection.connect(URL, autocommit=True) as lock_conn:
+        locked = (await (await lock_conn.execute("SELECT pg_try_advisory_lock(hashtext('rates_ingest'));")).fetchone())[0]
+        if not locked:
+            logging.info("Фоновая загрузка пропущена: её выполняет другой экземпляр бота")
+            return
+        try:
+            entry = await context.bot_data["rates_cache"].get()
+            await store_latest_rates(context, entry)
+        except Exception as e:
+            logging.error(f"Фоновая загрузка последних курсов не удалась: {e}")
+
+        # Сегодняшний день не догружаем через historical: его курсы ещё меняются и приходят из latest.json
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        end_date = today - datetime.timedelta(days=1)
+        start_date = today - datetime.timedelta(days=INGEST_KEEP_DAYS)
+        try:
+            if catch_up:
+                async with pool.connection() as conn:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(LATEST_DATE_QUERY, {"before": today})
+                        last_date = (await cursor.fetchone())[0]
+                if last_date:
+                    start_date = max(min(start_date, last_date + datetime.timedelta(days=1)),
+                                     today - datetime.timedelta(days=INGEST_CATCHUP_MAX_DAYS))
+            days = await find_missing_days(pool, "USD", start_date, end_date)
+            if days:
+                stored_days = await backfill_rates(pool, context.bot_data["rates_api"], days)
+                logging.info(f"Фоновая загрузка: догружено {stored_days} из {len(days)} пропущенных дней ({start_date} — {end_date})")
+        except Exception as e:
+            logging.error(f"Фоновая догрузка пропущенных дней не удалась: {e}")
+
+async def ingest_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Периодическая задача JobQueue: загрузка последних курсов
+    """
+    await ingest_rates(context)
+
+async def catch_up_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Разовая задача JobQueue при запуске бота: догрузка дней, пропущенных пока бот был выключен
+    """
+    await ingest_rates(context, catch_up=True)
+
+def render_chart(series: dict, title: str) -> bytes:
+    """
+    Функция рисует график курсов и возвращает его в формате PNG. Выполняется в пуле процессов.
+    series - словарь {(базовая валюта, валюта): (даты, курсы)}; если валют несколько, рисуется изменение курса в процентах, чтобы их можно было сравнить
+    """
+    # Используем Figure напрямую вместо pyplot: у каждого графика своё состояние, поэтому графики можно рисовать одновременно
+    fig = Figure(figsize= (14,8))
+    #Создаем стандартный график размером 14 на 8
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    relative = len(series) > 1
+    for (base, currency), (date, rates) in series.items():
+        if relative and rates:
+            rates = [(rate / rates[0] - 1) * 100 for rate in rates]
+        #dates  значение по осии x, rates значение по оси  y. Точки рисуем, только если их немного
+        ax.plot(date,rates,marker = 'o' if len(date) <= 31 else None, label= f"Обменный курс {base} к {currency}")
+    ax.set_title(title)
+    ax.set_xlabel ('Дата')
+    ax.set_ylabel ('Изменение курса, %' if relative else 'Обменный курс')
+    ax.legend() #Добавляем легенду
+    ax.grid(True) #Добавляем сетку
+    ax.tick_params(axis='x', labelrotation=40) #изменяем угол наклона надписей на оси X
+    buf =io.BytesIO()
+    canvas.print_png(buf)
+    #сохраняем график в формате пнг в буфер. Figure не регистрируется в pyplot, поэтому закрывать его не нужно - память освободится сборщиком мусора
+    return buf.getvalue()
+
+# Длины периодов для /plot: 7d - 7 дней, 4w - 4 недели, 6m - 6 месяцев, 1y - 1 год
+PERIOD_UNITS = {"d": 1, "w": 7, "m": 30, "y": 365}
+
+def parse_plot_args(args: list, default_days: int = 7) -> tuple:
+    """
+    Функция разбирает аргументы /plot и /stats: валюты через запятую, затем период (7d, 6m, 1y) или даты начала и конца.
+    Возвращает (валюты, дата начала или None, дата конца или None, длина периода в днях). Ошибку формата сообщает через ValueError
+    """
+    currencies = [currency for currency in args[0].upper().split(",") if currency]
+    if not currencies:
+        raise ValueError("не указана валюта")
+    start_date = end_date = None
+    days = default_days # по умолчанию для /plot - последняя неделя
+    rest = args[1:]
+    if len(rest) == 1 and rest[0][-1:].lower() in PERIOD_UNITS:
+        days = int(rest[0][:-1]) * PERIOD_UNITS[rest[0][-1].lower()]
+    elif rest:
+        start_date = datetime.datetime.strptime(rest[0], "%Y-%m-%d").date()
+        if len(rest) > 1:
+            end_date = datetime.datetime.strptime(rest[1], "%Y-%m-%d").date()
+    if days <= 0 or (start_date and end_date and start_date > end_date):
+        raise ValueError("неверный период")
+    return currencies, start_date, end_date, days
+
+class ChartCache:
+    """
+    Кэш готовых графиков /plot: PNG и file_id фото в Telegram после первой отправки (повторно отправляем по file_id, без загрузки файла).
+    Ключ - валюты, период и отпечаток данных графика; когда размер кэша превышает max_bytes, вытесняются давно не использованные графики.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # (currencies, start, end, fingerprint) -> {"png": bytes, "file_id": str или None}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> dict:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key) # недавно использованные графики - в конец очереди на вытеснение
+        return entry
+
+    def put(self, key: tuple, png: bytes) -> None:
+        if len(png) > self.max_bytes:
+            return
+        self._remove(key)
+        self.entries[key] = {"png": png, "file_id": None}
+        self.size += len(png)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+
+    def set_file_id(self, key: tuple, file_id: str) -> None:
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry["file_id"] = file_id
+
+    def invalidate(self, base_currency: str, date: datetime.date, rates: dict) -> None:
+        """
+        Функция удаляет графики валют, по которым в базу записаны новые курсы (вызывается из store_rates)
+        """
+        changed = set(rates)
+        for key in [key for key in self.entries if changed.intersection(key[0])]:
+            self._remove(key)
+
+    def _remove(self, key: tuple) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry["png"])
+
+# Последняя дата, за которую в базе есть курсы валют к USD (конец периода по умолчанию для /plot и /stats).
+#Коды валют заменяются на id подзапросами, тогда поиск идёт по первичному ключу rates в каждой секции
+LAST_DATE_QUERY = """
+    SELECT MAX(date)
+    FROM rates
+    WHERE base_id = (SELECT id FROM currencies WHERE code = 'USD')
+      AND currency_id = ANY(ARRAY(SELECT id FROM currencies WHERE code = ANY(%s)));
+"""
+
+# Отпечаток данных для графика /plot за период (для кэша графиков)
+PLOT_FINGERPRINT_QUERY = """
+    SELECT MAX(date), COUNT(*), MAX(updated_at)
+    FROM rates
+    WHERE base_id = (SELECT id FROM currencies WHERE code = 'USD')
+      AND currency_id = ANY(ARRAY(SELECT id FROM currencies WHERE code = ANY(%(currencies)s)))
+      AND date BETWEEN %(start)s AND %(end)s;
+"""
+
+# Курсы для графика /plot. Даты группируются в интервалы по step дней и курс внутри интервала усредняется,
+#поэтому даже за 10 лет база передаёт лишь несколько сотен точек. При step = 1 это обычные дневные курсы.
+PLOT_QUERY = """
+    SELECT c.code, t.bucket, t.rate
+    FROM (
+        SELECT currency_id,
+               %(start)s::date + (date - %(start)s::date) / %(step)s * %(step)s AS bucket,
+               AVG(rate) AS rate
+        FROM rates
+        WHERE base_id = (SELECT id FROM currencies WHERE code = 'USD')
+          AND currency_id = ANY(ARRAY(SELECT id FROM currencies WHERE code = ANY(%(currencies)s)))
+          AND date BETWEEN %(start)s AND %(end)s
+        GROUP BY currency_id, bucket
+    ) AS t
+    JOIN currencies c ON c.id = t.currency_id
+    ORDER BY c.code, t.bucket;
+"""
+
+RATE_MATRIX_CHUNK_ROWS = 10000 # Сколько строк курсов читать из базы за раз при загрузке матрицы
+
+class RateMatrix:
+    """
+    Матрица курсов в памяти: строка - день, столбец - валюта, значение - курс к USD (NaN, если курса нет).
+    Кросс-курс любой пары на дату - это отношение двух ячеек одной строки, без запросов к базе.
+    Загружается из базы при первом обращении и дополняется из store_rates при записи новых курсов.
+    """
+    def __init__(self):
+        self.start = None # дата первой строки матрицы
+        self.values = np.empty((0, 0))
+        self.columns = {} # валюта -> номер столбца
+        self.version = 0 # увеличивается при каждом изменении (для кэша графиков)
+        self.loaded = False
+        self.pending = None # обновления, пришедшие во время загрузки
+        self.lock = asyncio.Lock()
+
+    @property
+    def end(self) -> datetime.date:
+        return self.start + datetime.timedelta(days=len(self.values) - 1) if self.start else None
+
+    async def ensure_loaded(self, pool: AsyncConnectionPool) -> None:
+        """
+        Функция загружает все курсы к USD из базы при первом обращении
+        """
+        if self.loaded:
+            return
+        async with self.lock:
+            if self.loaded:
+                return
+            self.pending = []
+            chunks = []
+            async with pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("SELECT id, code FROM currencies;")
+                    codes = dict(await cursor.fetchall())
+                # Серверный курсор: курсы читаются частями, и в памяти не копится весь список строк.
+                #Без соединения со справочником (id валют переводятся в коды уже здесь), дата - номером дня, чтобы часть сразу стала массивом numpy
+                async with conn.cursor(name="rate_matrix_load") as cursor:
+                    await cursor.execute("""
+                        SELECT date - DATE '1970-01-01', currency_id, rate FROM rates
+                        WHERE base_id = (SELECT id FROM currencies WHERE code = 'USD');""")
+                    while rows := await cursor.fetchmany(RATE_MATRIX_CHUNK_ROWS):
+                        chunks.append(await asyncio.to_thread(np.array, rows, dtype=np.float64))
+            # Матрица собирается в отдельном потоке, чтобы не останавливать цикл событий (и другие обработчики) на время сборки
+            loaded = await asyncio.to_thread(self._build, chunks, codes)
+            if loaded:
+                self.start, self.columns, self.values = loaded
+            for date, rates in self.pending:
+                self._set_day(date, rates)
+            self.pending = None
+            self.loaded = True
+            self.version += 1
+            logging.info(f"Матрица курсов загружена: {self.values.shape[0]} дней x {self.values.shape[1]} валют")
+
+    @staticmethod
+    def _build(chunks: list, codes: dict) -> tuple:
+        """
+        Функция собирает матрицу из частей (массивов строк: номер дня, id валюты, курс) и возвращает (start, columns, values) или None, если курсов нет
+        """
+        if not chunks:
+            return None
+        data = np.concatenate(chunks)
+        days = data[:, 0].astype(np.int64)
+        ids = data[:, 1].astype(np.int64)
+        currency_ids = sorted(np.unique(ids).tolist(), key=codes.get)
+        id_columns = np.zeros(max(currency_ids) + 1, dtype=np.int64)
+        id_columns[currency_ids] = np.arange(len(currency_ids))
+        first_day = days.min()
+        values = np.full((days.max() - first_day + 1, len(currency_ids)), np.nan)
+        values[days - first_day, id_columns[ids]] = data[:, 2]
+        start = datetime.date(1970, 1, 1) + datetime.timedelta(days=int(first_day))
+        return start, {codes[currency_id]: i for i, currency_id in enumerate(currency_ids)}, values
+
+    def update(self, base_currency: str, date: datetime.date, rates: dict) -> None:
+        """
+        Функция дописывает в матрицу курсы за день (вызывается из store_rates)
+        """
+        if base_currency != "USD":
+            return
+        if self.pending is not None:
+            self.pending.append((date, rates))
+        elif self.loaded:
+            self._set_day(date, rates)
+
+    def _set_day(self, date: datetime.date, rates: dict) -> None:
+        new_currencies = [currency for currency in rates if currency not in self.columns]
+        if new_currencies:
+            for currency in new_currencies:
+                self.columns[currency] = len(self.columns)
+            self.values = np.hstack([self.values, np.full((len(self.values), len(new_currencies)), np.nan)])
+        if self.start is None:
+            self.start = date
+        if date < self.start: # день раньше начала матрицы - добавляем строки в начало
+            extra = (self.start - date).days
+            self.values = np.vstack([np.full((extra, len(self.columns)), np.nan), self.values])
+            self.start = date
+        row = (date - self.start).days
+        if row >= len(self.values): # день позже конца матрицы - добавляем строки в конец
+            self.values = np.vstack([self.values, np.full((row + 1 - len(self.values), len(self.columns)), np.nan)])
+        self.values[row, [self.columns[currency] for currency in rates]] = list(rates.values())
+        self.version += 1
+
+    def _column(self, currency: str) -> np.ndarray:
+        if currency == "USD": # все курсы хранятся к USD, поэтому его курс всегда 1
+            return np.ones(len(self.values))
+        if currency not in self.columns:
+            raise KeyError(currency)
+        return self.values[:, self.columns[currency]]
+
+    def cross_rate(self, base: str, quote: str, date: datetime.date = None) -> tuple:
+        """
+        Функция возвращает (дата, курс base к quote) на дату или последнюю дату до неё, за которую известны обе валюты.
+        Если курсов нет, возвращает None; неизвестную валюту сообщает через KeyError
+        """
+        base_rates, quote_rates = self._column(base), self._column(quote)
+        if not len(self.values) or (date is not None and date < self.start):
+            return None
+        row = len(self.values) - 1 if date is None else min((date - self.start).days, len(self.values) - 1)
+        while row >= 0: # обычно курс есть в первой же строке, назад идём только через пропущенные дни
+            if not (np.isnan(base_rates[row]) or np.isnan(quote_rates[row])):
+                return self.start + datetime.timedelta(days=row), quote_rates[row] / base_rates[row]
+            row -= 1
+        return None
+
+    def series(self, base: str, quote: str, start: datetime.date, end: datetime.date, max_points: int) -> tuple:
+        """
+        Функция возвращает (даты, курсы) пары base к quote за период, усредняя курсы по интервалам так,
+        чтобы точек было не больше max_points (как PLOT_QUERY в базе)
+        """
+        base_rates, quote_rates = self._column(base), self._column(quote)
+        if self.start is None:
+            return [], []
+        total = (end - start).days + 1
+        rows = np.arange(total) + (start - self.start).days
+        inside = (rows >= 0) & (rows < len(self.values))
+        values = np.full(total, np.nan)
+        values[inside] = quote_rates[rows[inside]] / base_rates[rows[inside]]
+        step = max(1, -(-total // max_points))
+        values = np.concatenate([values, np.full(-total % step, np.nan)]).reshape(-1, step)
+        counts = (~np.isnan(values)).sum(axis=1)
+        means = np.nansum(values, axis=1) / np.maximum(counts, 1)
+        buckets = np.flatnonzero(counts)
+        return [start + datetime.timedelta(days=int(i) * step) for i in buckets], means[buckets].tolist()
+
 # Декоратор для проверки авторизации
 def authorize(func):
     @wraps(func)
@@ -220,100 +1432,497 @@ async def plot(update: Update, context: ContextTypes.DEFAULT_TYPE)-> None:
     Функция рисует график курса валют за указанный период.
     """
     try:
-        currency = context.args[0].upper() #пользователь отправил команду с валютой, например: /plot USD
-    except:
-        await update.message.reply_text(f"Ошибка: укажите валюту в формате /plot USD")
+        #пользователь отправил команду с валютой, например: /plot USD, /plot USD,EUR,GBP 1y, /plot USD 2020-01-01 2024-12-31 или /plot EUR/JPY
+        currencies, start_date, end_date, days = parse_plot_args(context.args)
+    except (IndexError, ValueError):
+        await update.message.reply_text(f"Ошибка: укажите валюту в формате /plot USD [7d|4w|6m|1y] или /plot USD,EUR/JPY YYYY-MM-DD [YYYY-MM-DD]")
+        return
+    # Пары валют: EUR/JPY - курс EUR к JPY, просто EUR - курс USD к EUR
+    pairs = [tuple(item.split("/", 1)) if "/" in item else ("USD", item) for item in currencies]
+    # Валюты, от курсов которых зависит график (по ним сбрасывается кэш графиков)
+    sources = tuple(sorted({currency for pair in pairs for currency in pair} - {"USD"}))
 
-    await update.message.reply_text(f"Данные по {currency}")
+    await update.message.reply_text(f"Данные по {', '.join(currencies)}")
     #метод отправляет текстовое сообщение обратно пользователю в чат. Сообщение будет содержать информацию о валюте, 
     #переданной в команду (например, "Данные по USD").
+    chart_cache = context.bot_data["chart_cache"]
+    series = None
     try: #Начинает блок обработки исключений для отлова ошибок при работе с базой данных.
      #Почему: Работа с БД мб подвержена множ ошибок (например, проблемы с подкл)
-        conn = psycopg2.connect(URL)
-        #Устанавливает соединение с БД исп URL.Соединение необх для выполнения SQL-запросов
-        cursor = conn.cursor()
-        #Создает объект cursor, который используется для выполнения SQL-запросов. 
-        # f-строки для вставки переменной currency в запрос
-        # cursor.execute(f"""select date, rate from rates where currency = '{currency}' 
-        #                 and date >= '2024-12-01'
-        #                 order by date;""")
-        
-        # cursor.execute(f"""
-        #     SELECT date, rate 
-        #     FROM rates 
-        #     WHERE currency = '{currency}' 
-        #     AND date >= (
-        #         SELECT MAX(date) - INTERVAL '7 days'
-        #         FROM rates
-        #         WHERE currency = '{currency}'
-        #     )
-        #     ORDER BY date;
-        # """)
-        #!!!Безопасный подход: Используйте параметризованные запросы %s 
-        # При использовании %s, значения передаются отдельно от строки запроса и не интерпретируются как SQL-код
-        #Общая рекомендация:
-        #Всегда используйте параметризованные запросы при работе с пользовательскими данными.
-        #Избегайте использования f-строк для формирования SQL-запросов, если они содержат пользовательские данные.
-        #Проверяйте вводимые данные на уровне приложения, чтобы минимизировать риски.
-        cursor.execute("""
-            SELECT date, rate 
-            FROM rates 
-            WHERE currency = %s 
-            AND date >= (
-                SELECT MAX(date) - INTERVAL '7 days'
-                FROM rates
-                WHERE currency = %s
-            )
-            ORDER BY date;
-        """, (currency, currency))
-
-        #""" использование для переноса строки до и после
-        result = cursor.fetchall() #Извлекает все строки, возвращенные запросом, и сохраняет их в переменную result
-        #Он возвращает список кортежей, где каждый кортеж представляет собой одну строку из результатов запроса.
-        # await update.message.reply_text (f"Данные по {result}")
-        conn.commit() 
-        #Фиксируем изменение в транзакции
-        cursor.close()
-        conn.close()
-        #Закрывает курсор и соединение с базой данных. Открытые соединения потребляют ресурсы.
+        if any(base != "USD" for base, _ in pairs):
+            # Кросс-курсы считаются из матрицы курсов в памяти, без запросов к базе
+            matrix = context.bot_data["rate_matrix"]
+            await matrix.ensure_loaded(get_pool(context))
+            end_date = end_date or matrix.end
+            if end_date is None:
+                await update.message.reply_text("Нет данных о курсах")
+                return
+            start_date = start_date or end_date - datetime.timedelta(days=days)
+            key = (sources, start_date, end_date, ("matrix", tuple(pairs), matrix.version))
+            cached = chart_cache.get(key)
+            if cached is None:
+                series = {pair: matrix.series(*pair, start_date, end_date, PLOT_MAX_POINTS) for pair in pairs}
+        else:
+            async with get_pool(context).connection() as conn:
+                #Берёт соединение из общего пула. Соединение необх для выполнения SQL-запросов
+                async with conn.cursor() as cursor:
+                    #Создает объект cursor, который используется для выполнения SQL-запросов. 
+                    #!!!Безопасный подход: Используйте параметризованные запросы %s 
+                    # При использовании %s, значения передаются отдельно от строки запроса и не интерпретируются как SQL-код
+                    #Общая рекомендация:
+                    #Всегда используйте параметризованные запросы при работе с пользовательскими данными.
+                    #Избегайте использования f-строк для формирования SQL-запросов, если они содержат пользовательские данные.
+                    #Проверяйте вводимые данные на уровне приложения, чтобы минимизировать риски.
+
+                    if end_date is None:
+                        # Конец периода - последняя дата, за которую в базе есть курсы этих валют (первичный ключ rates)
+                        await cursor.execute(LAST_DATE_QUERY, (currencies,))
+                        end_date = (await cursor.fetchone())[0]
+                    if end_date is None:
+                        await update.message.reply_text(f"Нет данных по {', '.join(currencies)}")
+                        return
+                    if start_date is None:
+                        start_date = end_date - datetime.timedelta(days=days)
+
+                    # Отпечаток данных графика: последняя дата, количество строк и время последней записи.
+                    #Пока он не изменился, график будет тем же, и его можно взять из кэша, не рисуя заново
+                    await cursor.execute(PLOT_FINGERPRINT_QUERY, {"currencies": currencies, "start": start_date, "end": end_date})
+                    key = (sources, start_date, end_date, tuple(await cursor.fetchone()))
+                    cached = chart_cache.get(key)
+
+                    if cached is None:
+                        # На длинных периодах база сама усредняет курсы по интервалам в несколько дней,
+                        #поэтому передаётся и рисуется не больше PLOT_MAX_POINTS точек на валюту
+                        step = max(1, -(-((end_date - start_date).days + 1) // PLOT_MAX_POINTS)) # деление с округлением вверх
+                        await cursor.execute(PLOT_QUERY, {"currencies": currencies, "start": start_date, "end": end_date, "step": step})
+
+                        #""" использование для переноса строки до и после
+                        result = await cursor.fetchall() #Извлекает все строки, возвращенные запросом, и сохраняет их в переменную result
+                        #Он возвращает список кортежей, где каждый кортеж представляет собой одну строку из результатов запроса.
+                        # Раскладываем строки (валюта, дата, курс) по валютам: получили списки дат и значений обменного курса по каждой валюте
+                        series = {pair: ([], []) for pair in pairs}
+                        for currency, date, rate in result:
+                            series[("USD", currency)][0].append(date)
+                            series[("USD", currency)][1].append(rate)
+            #Курсор закрывается, а соединение возвращается в пул при выходе из блока async with.
+    except KeyError as e:
+        await update.message.reply_text(f"Нет данных по валюте {e.args[0]}")
+        return
     except Exception as e:
         logging.error(f"Произошла ошибка:{e}")
         #print(f'Ошибка:{e}')
         await update.message.reply_text(f'Ошибка:{e}')
+        return
 
-    date = [datetime.datetime.strftime(d[0], '%Y-%m-%d') for d in result]
-    #получили список дат по валюте
-    rates = [d[1] for d in result]
-    #получили список значений обменного курса по валюте
+    if all(base == "USD" for base, _ in pairs):
+        caption = f"График обменного курса USD к {', '.join(currency for _, currency in pairs)} за {start_date} — {end_date}"
+    else:
+        caption = f"График обменного курса {', '.join(f'{base} к {currency}' for base, currency in pairs)} за {start_date} — {end_date}"
+    if cached is not None:
+        # График уже есть в кэше: если Telegram уже знает это фото, отправляем только его file_id
+        message = await update.message.reply_photo(photo=cached["file_id"] or io.BytesIO(cached["png"]), caption=caption)
+        if message.photo and not cached["file_id"]:
+            chart_cache.set_file_id(key, message.photo[-1].file_id)
+        return
 
-    # await update.message.reply_text(f"Данные по {date}")
-    # await update.message.reply_text(f"Данные по {rates}")
+    series = {pair: values for pair, values in series.items() if values[0]}
+    if not series:
+        await update.message.reply_text(f"Нет данных по {', '.join(currencies)} за {start_date} — {end_date}")
+        return
 
-    plt.figure(figsize= (14,8))
-    #Создаем стандартный график размером 14 на 8
-    #dates  значение по осии x, rates значение по оси  y
-    plt.plot(date,rates,marker = 'o', label= f"Обменный курс USD к {currency}")
-    plt.xlabel ('Дата')
-    plt.ylabel ('Обменный курс')
-    plt.legend #Добавляем легенду
-    plt.grid #Добавляем сетку
-    plt.xticks(rotation=40) #изменяем угол наклона надписей на оси X
-    buf =io.BytesIO()
+    #Рисуем график в отдельном процессе, чтобы не останавливать цикл событий и другие обработчики на время отрисовки
+    loop = asyncio.get_running_loop()
+    with track("render"):
+        png = await loop.run_in_executor(context.bot_data["plot_executor"], render_chart, series, caption)
+    chart_cache.put(key, png)
+    buf = io.BytesIO(png)
     #Создает объект, который используем как буфер обм для хранения изобр
-    plt.savefig(buf, format ='png')
-    #сохраняем график в формате пнг в буфер
-    buf.seek(0)
-    #Перемещаем график в начало буфера обмена чтобы данные  можно было считать
-    plt.close()
-    #Закрывакм график, чтобы освободить ресурсы (память)
-    await update.message.reply_photo(photo=buf, caption =f"График обменного курса USD к {currency}")
+    message = await update.message.reply_photo(photo=buf, caption=caption)
+    if message.photo:
+        # Запоминаем file_id: следующие отправки этого графика не будут загружать файл заново
+        chart_cache.set_file_id(key, message.photo[-1].file_id)
+
+async def convert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Функция пересчитывает сумму из одной валюты в другую по кросс-курсу из матрицы курсов
+    """
+    try:
+        amount = float(context.args[0].replace(",", "."))
+        base, quote = context.args[1].upper(), context.args[2].upper()
+        date = datetime.datetime.strptime(context.args[3], "%Y-%m-%d").date() if len(context.args) > 3 else None
+    except (IndexError, ValueError):
+        await update.message.reply_text("Ошибка: укажите сумму и валюты в формате /convert 100 EUR JPY [YYYY-MM-DD]")
+        return
+
+    matrix = context.bot_data["rate_matrix"]
+    try:
+        await matrix.ensure_loaded(get_pool(context))
+        found = matrix.cross_rate(base, quote, date)
+    except KeyError as e:
+        await update.message.reply_text(f"Нет данных по валюте {e.args[0]}")
+        return
+    except Exception as e:
+        logging.error(f"Произошла ошибка:{e}")
+        await update.message.reply_text(f'Ошибка:{e}')
+        return
+    if found is None:
+        await update.message.reply_text(f"Нет курсов {base} и {quote} на эту дату")
+        return
+    rate_date, rate = found
+    await update.message.reply_text(f"{amount:g} {base} = {amount * rate:,.4f} {quote}\nКурс {base} к {quote}: {rate:.6g} на {rate_date}")
+
+# Месячные агрегаты валюты за полностью вошедшие в период месяцы
+STATS_MONTHS_QUERY = """
+    SELECT days, rate_sum, rate_sq_sum, rate_min, rate_max, change_count, change_sum, change_sq_sum
+    FROM rate_stats_monthly
+    WHERE base_currency = 'USD' AND currency = %(currency)s AND month >= %(start)s AND month < %(end)s;
+"""
+
+# Дневные курсы и их изменение в % для неполных месяцев на краях периода
+STATS_DAYS_QUERY = """
+    SELECT rate, change
+    FROM (
+        SELECT date, rate,
+               (rate / LAG(rate) OVER (ORDER BY date) - 1) * 100 AS change
+        FROM rates
+        WHERE base_id = (SELECT id FROM currencies WHERE code = 'USD')
+          AND currency_id = (SELECT id FROM currencies WHERE code = %(currency)s)
+          AND date BETWEEN %(start)s::date - 31 AND %(end)s
+    ) AS t
+    WHERE date >= %(start)s;
+"""
+
+# Последние 30 курсов до конца периода - для скользящих средних и изменения за день
+STATS_RECENT_QUERY = """
+    SELECT date, rate
+    FROM rates
+    WHERE base_id = (SELECT id FROM currencies WHERE code = 'USD')
+      AND currency_id = (SELECT id FROM currencies WHERE code = %(currency)s)
+      AND date <= %(end)s
+    ORDER BY date DESC
+    LIMIT 30;
+"""
+
+def combine_stats(months: list, day_rates: list, day_changes: list) -> dict:
+    """
+    Функция объединяет месячные агрегаты и дневные курсы краёв периода в итоговую статистику (векторно, через NumPy)
+    """
+    months = np.array(months, dtype=float).reshape(-1, 8)
+    day_rates = np.array(day_rates, dtype=float)
+    day_changes = np.array([change for change in day_changes if change is not None], dtype=float)
+    days = months[:, 0].sum() + day_rates.size
+    if days == 0:
+        return None
+    mean = (months[:, 1].sum() + day_rates.sum()) / days
+    minimum = np.concatenate([months[:, 3], day_rates]).min()
+    maximum = np.concatenate([months[:, 4], day_rates]).max()
+    # Волатильность - выборочное стандартное отклонение дневного изменения курса в % (из сумм и сумм квадратов)
+    n = months[:, 5].sum() + day_changes.size
+    volatility = None
+    if n > 1:
+        change_sum = months[:, 6].sum() + day_changes.sum()
+        change_sq_sum = months[:, 7].sum() + np.square(day_changes).sum()
+        variance = (change_sq_sum - change_sum ** 2 / n) / (n - 1)
+        volatility = float(np.sqrt(max(variance, 0.0)))
+    return {"days": int(days), "mean": float(mean), "min": float(minimum), "max": float(maximum), "volatility": volatility}
+
+def recent_stats(recent: list) -> dict:
+    """
+    Функция считает последний курс, изменение за день и скользящие средние за 7 и 30 дней (строки recent - от новых к старым)
+    """
+    rates = np.array([rate for _, rate in recent], dtype=float)
+    return {
+        "date": recent[0][0],
+        "rate": float(rates[0]),
+        "change": float((rates[0] / rates[1] - 1) * 100) if rates.size > 1 else None,
+        "ma7": float(rates[:7].mean()),
+        "ma30": float(rates[:30].mean()),
+    }
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Функция присылает статистику курса валюты за период: минимум, максимум, среднее, волатильность, изменение за день и скользящие средние
+    """
+    try:
+        currencies, start_date, end_date, days = parse_plot_args(context.args, default_days=30)
+        currency = currencies[0]
+    except (IndexError, ValueError):
+        await update.message.reply_text("Ошибка: укажите валюту в формате /stats EUR [30d|6m|1y] или /stats EUR YYYY-MM-DD [YYYY-MM-DD]")
+        return
+
+    try:
+        async with get_pool(context).connection() as conn:
+            async with conn.cursor() as cursor:
+                if end_date is None:
+                    await cursor.execute(LAST_DATE_QUERY, ([currency],))
+                    end_date = (await cursor.fetchone())[0]
+                if end_date is None:
+                    await update.message.reply_text(f"Нет данных по {currency}")
+                    return
+                if start_date is None:
+                    start_date = end_date - datetime.timedelta(days=days)
+
+                # Целые месяцы периода берём из таблицы агрегатов (одна строка на месяц), края периода - из дневных курсов
+                first_full = start_date if start_date.day == 1 else next_month(start_date)
+                after_end = end_date + datetime.timedelta(days=1)
+                last_full = after_end if after_end.day == 1 else month_start(end_date) # граница целых месяцев (не включая)
+                months = []
+                edges = [(start_date, end_date)]
+                if first_full < last_full:
+                    await cursor.execute(STATS_MONTHS_QUERY, {"currency": currency, "start": first_full, "end": last_full})
+                    months = await cursor.fetchall()
+                    edges = [(start_date, first_full - datetime.timedelta(days=1)), (last_full, end_date)]
+                day_rows = []
+                for edge_start, edge_end in edges:
+                    if edge_start <= edge_end:
+                        await cursor.execute(STATS_DAYS_QUERY, {"currency": currency, "start": edge_start, "end": edge_end})
+                        day_rows += await cursor.fetchall()
+
+                await cursor.execute(STATS_RECENT_QUERY, {"currency": currency, "end": end_date})
+                recent = await cursor.fetchall()
+    except Exception as e:
+        logging.error(f"Произошла ошибка:{e}")
+        await update.message.reply_text(f'Ошибка:{e}')
+        return
+
+    period = combine_stats(months, [rate for rate, _ in day_rows], [change for _, change in day_rows])
+    if period is None or not recent:
+        await update.message.reply_text(f"Нет данных по {currency} за {start_date} — {end_date}")
+        return
+    last = recent_stats(recent)
+    change = f"{last['change']:+.2f}%" if last["change"] is not None else "—"
+    volatility = f"{period['volatility']:.2f}%" if period["volatility"] is not None else "—"
+    await update.message.reply_text(
+        f"📊 USD к {currency} за {start_date} — {end_date} ({period['days']} дн.)\n"
+        f"Последний курс ({last['date']}): {last['rate']:.6g} ({change} за день)\n"
+        f"Минимум: {period['min']:.6g}\n"
+        f"Максимум: {period['max']:.6g}\n"
+        f"Среднее: {period['mean']:.6g}\n"
+        f"Волатильность (ст. откл. дневного изменения): {volatility}\n"
+        f"Скользящее среднее 7 дн.: {last['ma7']:.6g}, 30 дн.: {last['ma30']:.6g}"
+    )
+
+# Выгрузка истории курсов. Строки читаются серверным курсором порциями по EXPORT_CHUNK_ROWS и сразу пишутся в файл,
+#поэтому память не зависит от размера выгрузки. currency_filter - пусто (все валюты) или условие на одну валюту
+EXPORT_QUERY = """
+    SELECT r.date, b.code, c.code, r.rate
+    FROM rates r
+    JOIN currencies b ON b.id = r.base_id
+    JOIN currencies c ON c.id = r.currency_id
+    WHERE r.date BETWEEN %(start)s AND %(end)s {currency_filter}
+    ORDER BY r.date, c.code
+"""
+EXPORT_COLUMNS = ["date", "base_currency", "currency", "rate"]
+EXPORT_FORMATS = ("csv", "parquet")
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024 # Максимальный размер файла, который бот может отправить в Telegram
+
+def export_query(currency: str = None) -> sql.Composed:
+    """
+    Функция возвращает запрос выгрузки курсов: всех валют (currency = None) или одной
+    """
+    currency_filter = sql.SQL("")
+    if currency:
+        currency_filter = sql.SQL("AND r.currency_id = (SELECT id FROM currencies WHERE code = %(currency)s)")
+    return sql.SQL(EXPORT_QUERY).format(currency_filter=currency_filter)
+
+class RatesFileWriter:
+    """
+    Запись строк курсов (date, base_currency, currency, rate) в CSV или Parquet порциями.
+    В Parquet каждая порция становится отдельной группой строк, так что файл пишется без накопления всех данных в памяти
+    """
+    def __init__(self, file, fmt: str):
+        self.fmt = fmt
+        self.rows = 0
+        if fmt == "parquet":
+            # pyarrow нужен только для Parquet, поэтому импортируется здесь, а не при запуске бота
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.pa = pa
+            self.schema = pa.schema([("date", pa.date32()), ("base_currency", pa.string()),
+                                     ("currency", pa.string()), ("rate", pa.float64())])
+            self.writer = pq.ParquetWriter(file, self.schema, compression="zstd")
+        else:
+            self.text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+            self.writer = csv.writer(self.text)
+            self.writer.writerow(EXPORT_COLUMNS)
+
+    def write(self, rows: list) -> None:
+        if self.fmt == "parquet":
+            columns = list(zip(*rows)) if rows else [[]] * len(EXPORT_COLUMNS)
+            self.writer.write_table(self.pa.Table.from_arrays([self.pa.array(column, type=field.type)
+                                                               for column, field in zip(columns, self.schema)], schema=self.schema))
+        else:
+            self.writer.writerows(rows)
+        self.rows += len(rows)
+
+    def close(self) -> None:
+        if self.fmt == "parquet":
+            self.writer.close()
+        else:
+            self.text.flush()
+            self.text.detach() # файл закрывает тот, кто его открыл
+
+async def export_rates(pool: AsyncConnectionPool, file, fmt: str, currency: str, start_date: datetime.date, end_date: datetime.date) -> int:
+    """
+    Функция выгружает курсы за период в открытый двоичный файл и возвращает количество строк
+    """
+    writer = RatesFileWriter(file, fmt)
+    async with pool.connection() as conn:
+        async with conn.cursor(name="rates_export") as cursor: # именованный (серверный) курсор
+            await cursor.execute(export_query(currency), {"start": start_date, "end": end_date, "currency": currency})
+            while rows := await cursor.fetchmany(EXPORT_CHUNK_ROWS):
+                # Запись в файл (особенно сжатие Parquet) выполняется в отдельном потоке, чтобы не задерживать другие обработчики
+                await asyncio.to_thread(writer.write, rows)
+    await asyncio.to_thread(writer.close)
+    return writer.rows
+
+@authorize
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Функция выгружает историю курсов валюты (или всех валют) за период файлом CSV или Parquet
+    """
+    try:
+        currency = context.args[0].upper()
+        start_date = datetime.datetime.strptime(context.args[1], "%Y-%m-%d").date()
+        end_date = datetime.datetime.strptime(context.args[2], "%Y-%m-%d").date()
+        fmt = context.args[3].lower() if len(context.args) > 3 else "csv"
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(fmt)
+    except (IndexError, ValueError):
+        await update.message.reply_text("Укажите параметры в формате: /export EUR|ALL YYYY-MM-DD YYYY-MM-DD [csv|parquet]")
+        return
+
+    try:
+        with tempfile.TemporaryFile() as file:
+            rows = await export_rates(get_pool(context), file, fmt, None if currency == "ALL" else currency, start_date, end_date)
+            if rows == 0:
+                await update.message.reply_text(f"Нет курсов {currency} за {start_date} — {end_date}")
+                return
+            if file.tell() > TELEGRAM_FILE_LIMIT:
+                await update.message.reply_text(f"Файл получился больше 50 МБ ({rows} строк). Уменьшите период или выберите parquet")
+                return
+            file.seek(0)
+            await update.message.reply_document(document=file, filename=f"rates_{currency}_{start_date}_{end_date}.{fmt}",
+                                                caption=f"Курсов: {rows}")
+    except ImportError:
+        await update.message.reply_text("Для выгрузки в Parquet нужен пакет pyarrow")
+    except Exception as e:
+        logging.error(f"Произошла ошибка:{e}")
+        await update.message.reply_text(f"Ошибка:{e}")
+
+def copy_rates_file(copy, path: str) -> None:
+    """
+    Функция передаёт файл выгрузки в COPY ... (FORMAT csv) блоками, без разбора строк в Python.
+    Parquet читается группами строк и каждая группа перекодируется в CSV средствами pyarrow
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(path)
+        for batch in parquet.iter_batches(batch_size=EXPORT_CHUNK_ROWS, columns=EXPORT_COLUMNS):
+            buffer = io.BytesIO()
+            pa_csv.write_csv(batch, buffer, pa_csv.WriteOptions(include_header=False))
+            copy.write(buffer.getvalue())
+    else:
+        with open(path, "rb") as file:
+            while block := file.read(1024 * 1024):
+                copy.write(block)
+
+# Перенос загруженных во временную таблицу курсов в rates. Новые валюты сначала добавляются в справочник
+IMPORT_CURRENCIES_QUERY = """
+    INSERT INTO currencies (code)
+    SELECT code FROM (SELECT base_currency AS code FROM rates_import UNION SELECT currency FROM rates_import) AS t
+    WHERE NOT EXISTS (SELECT 1 FROM currencies c WHERE c.code = t.code)
+    ORDER BY code
+    ON CONFLICT (code) DO NOTHING;
+"""
+
+# Строки пишутся в порядке дат, как и при обычной загрузке по дням, - на этом держится BRIN-индекс rates_date_brin_idx
+IMPORT_RATES_QUERY = """
+    INSERT INTO rates (date, base_id, currency_id, rate)
+    SELECT i.date, b.id, c.id, i.rate
+    FROM rates_import i
+    JOIN currencies b ON b.code = i.base_currency
+    JOIN currencies c ON c.code = i.currency
+    ORDER BY i.date, b.id, c.id
+    ON CONFLICT (base_id, currency_id, date) DO UPDATE
+       SET rate = EXCLUDED.rate,
+           updated_at = now();
+"""
+
+def import_rates(path: str) -> int:
+    """
+    Функция загружает курсы из файла CSV или Parquet (в формате выгрузки export) в базу и возвращает количество строк.
+    Файл передаётся в базу через COPY во временную таблицу, затем одним запросом переносится в rates
+    """
+    with psycopg.connect(URL) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE rates_import (date DATE, base_currency TEXT, currency TEXT, rate DOUBLE PRECISION) ON COMMIT DROP;")
+            header = "false" if path.endswith(".parquet") else "true"
+            with cursor.copy(f"COPY rates_import (date, base_currency, currency, rate) FROM STDIN WITH (FORMAT csv, HEADER {header})") as copy:
+                copy_rates_file(copy, path)
+            cursor.execute(IMPORT_CURRENCIES_QUERY)
+            # Секции rates за все годы файла
+            cursor.execute("SELECT DISTINCT EXTRACT(YEAR FROM date)::int FROM rates_import;")
+            years = [year for (year,) in cursor.fetchall()]
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('rates_partitions'));")
+            for year in years:
+                cursor.execute(rates_partition_query(year))
+            cursor.execute(IMPORT_RATES_QUERY)
+            imported = cursor.rowcount
+            # Пересчёт агрегатов /stats за период файла
+            cursor.execute("SELECT base_currency, array_agg(DISTINCT currency), MIN(date), MAX(date) FROM rates_import GROUP BY base_currency;")
+            ranges = cursor.fetchall()
+            cursor.execute(STATS_LOCK_QUERY)
+            for base_currency, currencies, start_date, end_date in ranges:
+                cursor.execute(REFRESH_STATS_QUERY, {"base": base_currency, "currencies": currencies,
+                                                     "from": month_start(start_date), "to": next_month(next_month(end_date))})
+        conn.commit()
+    return imported
+
+def export_rates_to_file(path: str, fmt: str, currency: str, start_date: datetime.date, end_date: datetime.date) -> int:
+    """
+    Функция выгружает курсы в файл path (для командной строки) и возвращает количество строк
+    """
+    async def run() -> int:
+        async with AsyncConnectionPool(URL, min_size=1, max_size=1) as pool:
+            with open(path, "wb") as file:
+                return await export_rates(pool, file, fmt, currency, start_date, end_date)
+    return asyncio.run(run())
+
+def cli(argv: list) -> None:
+    """
+    Выгрузка и загрузка истории курсов из командной строки, без запуска бота:
+    python bot.py export rates.parquet [--currency EUR] [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+    python bot.py import rates.parquet
+    """
+    parser = argparse.ArgumentParser(prog="bot.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="выгрузить курсы в CSV или Parquet (по расширению файла)")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--currency", help="код валюты, по умолчанию все валюты")
+    export_parser.add_argument("--from", dest="start", type=datetime.date.fromisoformat, default=datetime.date.min)
+    export_parser.add_argument("--to", dest="end", type=datetime.date.fromisoformat, default=datetime.date.max)
+    import_parser = commands.add_parser("import", help="загрузить курсы из файла выгрузки через COPY")
+    import_parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    init_db()
+    started = time.perf_counter()
+    if args.command == "export":
+        fmt = "parquet" if args.path.endswith(".parquet") else "csv"
+        rows = export_rates_to_file(args.path, fmt, args.currency and args.currency.upper(), args.start, args.end)
+    else:
+        rows = import_rates(args.path)
+    elapsed = time.perf_counter() - started
+    print(f"{args.command}: {rows} строк за {elapsed:.1f} с ({rows / elapsed:,.0f} строк/с)")
 
 def init_db(): # Фунция, которая не принимает аргументов. Она выполняет операции по подключению к базе данных и созданию таблиц.
     """
     Функция для инициализации базы данных PostgreSQL, включая создание нескольких таблиц
     """
-    try: #блок происходит подключение к базе данных PostgreSQL с помощью библиотеки psycopg2
-        conn=psycopg2.connect(URL)
+    try: #блок происходит подключение к базе данных PostgreSQL с помощью библиотеки psycopg
+        conn=psycopg.connect(URL) #init_db выполняется до запуска цикла событий, поэтому здесь обычное синхронное подключение
         cursor = conn.cursor()
         
         #Создания таблицы messages, если она не существует.  
@@ -323,6 +1932,8 @@ def init_db(): # Фунция, которая не принимает аргум
         # username: имя пользователя, отправившего сообщение.
         #прямой запрос cursor.execute.Запрос пишется непосредственно в методе cursor.execute 
         cursor.execute("CREATE TABLE IF NOT EXISTS messages (id SERIAL PRIMARY KEY, text TEXT, username TEXT);") 
+        #Индекс для постраничного вывода сообщений пользователя: WHERE username = ... AND id > ... ORDER BY id
+        cursor.execute("CREATE INDEX IF NOT EXISTS messages_username_id_idx ON messages (username, id);")
         
         # Создание таблицы  message_updates, если она еще не существует
         #предназначена для хранения более подробной информации о сообщениях
@@ -349,25 +1960,117 @@ def init_db(): # Фунция, которая не принимает аргум
     except Exception as e:
         print(f'Ошибка:{e}') 
 
+    # Ошибка здесь останавливает запуск: без новой схемы rates (например, если перенос данных не удался) обработчики работать не смогут.
+    #Соединение закрывается с откатом, поэтому незавершённый перенос не оставляет базу наполовину изменённой
     try:
-        conn=psycopg2.connect(URL)
-        cursor = conn.cursor()
+        with psycopg.connect(URL) as conn:
+            cursor = conn.cursor()
+            init_rates_schema(cursor)
+        print ('Таблицы rates создана')
+    except Exception as e:
+        print(f'Ошибка:{e}')
+        raise
 
-        # Создание таблицы rates если она не существует
+def init_rates_schema(cursor: psycopg.Cursor) -> None:
+    """
+    Функция создаёт таблицы курсов (currencies, rates с секциями по годам, rate_stats_monthly) и переносит курсы из старой схемы.
+    Вызывается из init_db в одной транзакции
+    """
+    # Курсы хранятся компактно: коды валют вынесены в справочник currencies (id типа smallint вместо текста в каждой строке),
+    #курс - float8 (REAL терял точность на больших курсах вроде IDR/VND). Таблица rates разбита на секции по годам (rates_2024, ...),
+    #секция на новый год создаётся при первой записи в неё (ensure_rates_partition)
+    cursor.execute("CREATE TABLE IF NOT EXISTS currencies (id SMALLSERIAL PRIMARY KEY, code TEXT NOT NULL UNIQUE);")
+    # Старая схема (base_currency и currency текстом, rate REAL) - переносим данные в новую таблицу
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('rates');")
+    row = cursor.fetchone()
+    migrate = row is not None and row[0] == 'r'
+    if migrate:
+        # В самой старой схеме нет updated_at (добавлялся отдельно) - переносим такие строки со временем миграции
+        cursor.execute("ALTER TABLE rates ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();")
+        cursor.execute("ALTER TABLE rates RENAME TO rates_legacy;")
+        cursor.execute("ALTER INDEX IF EXISTS rates_pkey RENAME TO rates_legacy_pkey;")
+        cursor.execute("DROP INDEX IF EXISTS rates_currency_date_idx;")
+    # Создание таблицы rates если она не существует.
+    #Первичный ключ (base_id, currency_id, date) обслуживает выборки по валюте за период (/plot, /stats)
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS rates
+                   (date DATE NOT NULL,
+                    base_id SMALLINT NOT NULL REFERENCES currencies (id),
+                    currency_id SMALLINT NOT NULL REFERENCES currencies (id),
+                    rate DOUBLE PRECISION,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), -- время последней записи: по нему определяется, какие дни устарели
+                    PRIMARY KEY (base_id, currency_id, date))
+                   PARTITION BY RANGE (date);""")
+    # BRIN-индекс по дате для выборок всех валют за период (поиск пропущенных дней): курсы записываются по дням (store_rates),
+    #а перенос из старой схемы и импорт тоже пишут строки в порядке дат, поэтому каждый диапазон блоков секции покрывает несколько дней
+    #и индекс отсекает лишние блоки, занимая килобайты вместо мегабайт у B-tree. Секция за год - всего несколько сотен блоков,
+    #поэтому диапазон уменьшен до 16 блоков (по умолчанию 128): выборка за месяц читает ~50 блоков секции вместо ~140
+    cursor.execute("CREATE INDEX IF NOT EXISTS rates_date_brin_idx ON rates USING brin (date) WITH (pages_per_range = 16);")
+    # Курсы с кодами валют, как в старой таблице rates - для запросов чтения
+    cursor.execute("""
+                   CREATE OR REPLACE VIEW rates_by_code AS
+                   SELECT b.code AS base_currency, r.date, c.code AS currency, r.rate, r.updated_at
+                   FROM rates r
+                   JOIN currencies b ON b.id = r.base_id
+                   JOIN currencies c ON c.id = r.currency_id;""")
+    today = datetime.date.today()
+    years = {today.year, today.year + 1}
+    if migrate:
+        cursor.execute("""
+                       INSERT INTO currencies (code)
+                       SELECT base_currency FROM rates_legacy UNION SELECT currency FROM rates_legacy
+                       ORDER BY 1
+                       ON CONFLICT (code) DO NOTHING;""")
+        cursor.execute("SELECT DISTINCT EXTRACT(YEAR FROM date)::int FROM rates_legacy;")
+        years |= {year for (year,) in cursor.fetchall()}
+    for year in sorted(years):
+        cursor.execute(rates_partition_query(year))
+    # Запоминаем уже существующие секции (rates_ГГГГ), чтобы store_rates не пытался создать их заново
+    cursor.execute("""
+                   SELECT substring(c.relname FROM '^rates_([0-9]{4})$')::int
+                   FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                   WHERE i.inhparent = 'rates'::regclass;""")
+    RATES_PARTITIONS.update(year for (year,) in cursor.fetchall())
+    if migrate:
+        # rate::text::float8 переносит REAL как есть (0.9, а не 0.899999976158142).
+        #Строки пишутся в порядке дат, как при обычной загрузке по дням, - это нужно BRIN-индексу по дате
         cursor.execute("""
-                       CREATE TABLE IF NOT EXISTS rates 
-                       (base_currency TEXT,
-                        date DATE,
-                        currency TEXT,
-                        rate REAL,
-                        PRIMARY KEY (base_currency, date, currency));""")
+                       INSERT INTO rates (date, base_id, currency_id, rate, updated_at)
+                       SELECT r.date, b.id, c.id, r.rate::text::float8, r.updated_at
+                       FROM rates_legacy r
+                       JOIN currencies b ON b.code = r.base_currency
+                       JOIN currencies c ON c.code = r.currency
+                       ORDER BY r.date, b.id, c.id;""")
+        print(f'Курсы перенесены в новую схему: {cursor.rowcount} строк')
+        cursor.execute("DROP TABLE rates_legacy;")
+        # Агрегаты /stats пересчитываются ниже по перенесённым курсам
+        cursor.execute("DROP TABLE IF EXISTS rate_stats_monthly;")
 
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print ('Таблицы rates создана')
-    except Exception as e:
-        print(f'Ошибка:{e}') 
+    # Месячные агрегаты курсов для /stats: суммы, суммы квадратов, минимум и максимум курса и его дневного изменения в %.
+    #Обновляются в store_rates только за месяцы, которые затронула запись
+    cursor.execute("""
+                   CREATE TABLE IF NOT EXISTS rate_stats_monthly
+                   (base_currency TEXT,
+                    currency TEXT,
+                    month DATE,
+                    days INT,
+                    rate_sum DOUBLE PRECISION,
+                    rate_sq_sum DOUBLE PRECISION,
+                    rate_min DOUBLE PRECISION,
+                    rate_max DOUBLE PRECISION,
+                    change_count INT,
+                    change_sum DOUBLE PRECISION,
+                    change_sq_sum DOUBLE PRECISION,
+                    PRIMARY KEY (base_currency, currency, month));""")
+    # Первое заполнение агрегатов по уже сохранённой истории
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM rate_stats_monthly);")
+    if not cursor.fetchone()[0]:
+        cursor.execute("SELECT DISTINCT base_currency, currency FROM rates_by_code;")
+        pairs = cursor.fetchall()
+        cursor.execute(STATS_LOCK_QUERY)
+        for base_currency in {base for base, _ in pairs}:
+            cursor.execute(REFRESH_STATS_QUERY, {"base": base_currency, "currencies": [c for b, c in pairs if b == base_currency],
+                                                 "from": datetime.date(1900, 1, 1), "to": datetime.date.max})
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None: 
     """
@@ -375,6 +2078,119 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     await update.message.reply_text("Привет, я бот с буткемпа")
 
+class MessageLogWriter:
+    """
+    Отложенная пакетная запись сообщений из echo. Обработчик только кладёт запись в очередь, а фоновая задача
+    записывает накопившиеся сообщения одной командой COPY на таблицу - когда набралось batch_size записей или прошло flush_interval секунд.
+    Очередь ограничена: если база не успевает, обработчики ждут места в очереди (обратное давление).
+    Неудачная запись пачки повторяется retries раз с растущей паузой, и только потом пачка отбрасывается.
+    """
+    def __init__(self, pool: AsyncConnectionPool, batch_size: int, flush_interval: float, max_queue: int,
+                 retries: int, retry_delay: float):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.batch_ready = asyncio.Event() # набралась целая пачка - записываем, не дожидаясь flush_interval
+        self.task = None
+        self.flushes = 0
+        self.rows = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Функция записывает всё, что осталось в очереди, и останавливает фоновую задачу
+        """
+        if self.task is None:
+            return
+        await self.queue.put(None) # признак остановки - после него записей не будет
+        self.batch_ready.set()
+        await self.task
+        self.task = None
+        logging.info(f"Статистика записи сообщений: {self.stats()}")
+
+    async def put(self, message: tuple, message_update: tuple) -> None:
+        """
+        Функция ставит сообщение в очередь на запись: message - строка для messages, message_update - для message_updates
+        """
+        await self.queue.put((message, message_update))
+        if self.queue.qsize() >= self.batch_size:
+            self.batch_ready.set()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "flushes": self.flushes,
+            "rows": self.rows,
+            "errors": self.errors,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            # Ждём, пока наберётся пачка, но не дольше flush_interval
+            try:
+                await asyncio.wait_for(self.batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.batch_ready.clear()
+            batch = [item]
+            stopping = False
+            while len(batch) < self.batch_size and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            # Пока шла запись предыдущей пачки, put мог установить событие, а clear выше его сбросил:
+            #если в очереди уже есть целая пачка, пишем её сразу, не дожидаясь flush_interval
+            if self.queue.qsize() >= self.batch_size:
+                self.batch_ready.set()
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: list) -> None:
+        started = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                await self._copy(batch)
+                break
+            except Exception as e:
+                # Транзакция с частью пачки откатилась, поэтому пачку можно записать заново целиком
+                if attempt == self.retries:
+                    self.errors += 1
+                    logging.error(f"Не удалось записать {len(batch)} сообщений: {e}")
+                    return
+                logging.warning(f"Ошибка записи {len(batch)} сообщений, попытка {attempt + 1} из {self.retries + 1}: {e}")
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        self.total_flush_ms += self.last_flush_ms
+        self.flushes += 1
+        self.rows += len(batch)
+
+    async def _copy(self, batch: list) -> None:
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                async with cursor.copy("COPY messages (text, username) FROM STDIN") as copy:
+                    for message, _ in batch:
+                        await copy.write_row(message)
+                async with cursor.copy("COPY message_updates (message_text, user_id, user_name, is_bot, message_id, date) FROM STDIN") as copy:
+                    for _, message_update in batch:
+                        await copy.write_row(message_update)
+            await conn.commit()
+
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Функция эхо-ответ пользователю, сохранение данных в базу
@@ -389,23 +2205,10 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(user_username) #Это может быть полезно, если бот логирует действия пользователей 
     #или использует их имя для персонализации сообщений.
     
-    # Сохранение в базу данных
-    try:
-        conn=psycopg2.connect(URL)
-        cursor=conn.cursor()
-        cursor.execute("INSERT INTO messages (text, username) VALUES (%s, %s);", (user_messages, user_username))
-
-        # Преобразование UNIX времени в формат TIMESTAMP
-        # date = datetime.datetime.fromtimestamp(update.message["date"])
-
-        # Вставка данных в таблицу
-        insert_query = """
-        INSERT INTO message_updates (message_text, user_id, user_name, is_bot, message_id, date)
-        VALUES (%s, %s, %s, %s, %s, %s);
-        """
-
-        cursor.execute(insert_query, 
-        (
+    # Сохранение в базу данных: запись ставится в очередь и попадает в базу пачкой вместе с другими сообщениями
+    await context.bot_data["message_writer"].put(
+        (user_messages, user_username), # строка для таблицы messages
+        (                               # строка для таблицы message_updates
             user_messages,
             update.message.from_user.id,
             update.message.from_user.username,
@@ -414,40 +2217,167 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             update.message.date
         ))
 
-        conn.commit()
-        cursor.close()
-        conn.close()
-    except Exception as e:
-        print(f'Ошибка:{e}')
+MESSAGE_TEXT_LIMIT = 4096 # Максимальная длина сообщения в Telegram
+
+# Страница сообщений пользователя. Постраничный вывод по ключу (keyset): следующая страница начинается после последнего показанного id,
+#поэтому запрос идёт по индексу messages_username_id_idx и не зависит от того, насколько далеко листает пользователь (в отличие от OFFSET)
+MESSAGES_PAGE_QUERY = """
+    SELECT id, text FROM messages
+    WHERE username = %(username)s AND id > %(after_id)s
+    ORDER BY id
+    LIMIT %(limit)s;
+"""
+
+async def load_messages_page(pool: AsyncConnectionPool, username: str, after_id: int) -> tuple:
+    """
+    Функция возвращает страницу сообщений пользователя после after_id: (текст страницы, id последнего сообщения на странице, есть ли ещё сообщения)
+    Страница обрезается так, чтобы уместиться в одно сообщение Telegram
+    """
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            # Берём на одну строку больше, чтобы узнать, есть ли следующая страница, без отдельного COUNT
+            await cursor.execute(MESSAGES_PAGE_QUERY, {"username": username, "after_id": after_id, "limit": MESSAGES_PAGE_SIZE + 1})
+            rows = await cursor.fetchall()
+    lines = []
+    length = 0
+    last_id = after_id
+    for message_id, text in rows[:MESSAGES_PAGE_SIZE]:
+        line = f" {text}"
+        if len(line) > MESSAGE_TEXT_LIMIT:
+            line = line[:MESSAGE_TEXT_LIMIT - 1] + "…"
+        if lines and length + len(line) + 1 > MESSAGE_TEXT_LIMIT:
+            break # не поместилось - сообщение попадёт на следующую страницу
+        lines.append(line)
+        length += len(line) + 1
+        last_id = message_id
+    has_more = len(rows) > len(lines)
+    return "\n".join(lines), last_id, has_more
+
+def messages_page_keyboard(last_id: int, has_more: bool) -> InlineKeyboardMarkup:
+    """
+    Функция строит кнопки под страницей сообщений: следующая страница и выгрузка всей истории файлом
+    """
+    if not has_more:
+        return None
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("Дальше ▶️", callback_data=f"messages:{last_id}"),
+        InlineKeyboardButton("📄 Всё файлом", callback_data="messages:file"),
+    ]])
+
+async def send_messages_file(message, pool: AsyncConnectionPool, username: str) -> None:
+    """
+    Функция выгружает все сообщения пользователя в текстовый файл и отправляет его документом.
+    Строки читаются серверным курсором порциями и сразу пишутся во временный файл, так что история целиком в памяти не держится
+    """
+    count = 0
+    with tempfile.TemporaryFile() as file:
+        async with pool.connection() as conn:
+            async with conn.cursor(name="messages_export") as cursor: # именованный (серверный) курсор
+                await cursor.execute("SELECT text FROM messages WHERE username = %s ORDER BY id;", (username,))
+                async for (text,) in cursor:
+                    file.write(f"{text}\n".encode())
+                    count += 1
+        file.seek(0)
+        await message.reply_document(document=file, filename=f"messages_{username}.txt", caption=f"Сообщений: {count}")
 
 async def return_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Функция для получения всех сообщений пользователя из базы данных и отправки их обратно пользователю через Telegram-бота
+    Функция для получения всех сообщений пользователя из базы данных и отправки их обратно пользователю через Telegram-бота.
+    Сообщения показываются по страницам с кнопкой "Дальше"; /return_all_messages file присылает всю историю файлом
     """
     user_username = update.message.from_user.username
 
     try:
-        conn=psycopg2.connect(URL)
-        cursor=conn.cursor()
-        cursor.execute(f"SELECT text from messages where username = '{user_username}';")
-        #Выбираем всю информацию из таблицы messages
-        result = cursor.fetchall()
+        if "file" in context.args:
+            await send_messages_file(update.message, get_pool(context), user_username)
+            return
+        text, last_id, has_more = await load_messages_page(get_pool(context), user_username, 0)
+        if not text:
+            await update.message.reply_text("Сообщений пока нет")
+            return
+        await update.message.reply_text(text, reply_markup=messages_page_keyboard(last_id, has_more))
+    except Exception as e:
+        logging.error(f"Произошла ошибка:{e}")
+        await update.message.reply_text(f'Ошибка:{e}')
 
-        logging.info(result)
-        decoded_results = [f' {row[0]}' for row in result]
-        logging.info(decoded_results)
+async def messages_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Функция обрабатывает кнопки под страницей сообщений. Сообщения берутся по нажавшему кнопку пользователю,
+    поэтому чужую историю через callback_data не получить
+    """
+    query = update.callback_query
+    await query.answer()
+    user_username = query.from_user.username
+    action = query.data.split(":", 1)[1]
 
-        formatted_results = "\n".join(decoded_results)
+    try:
+        if action == "file":
+            await query.edit_message_reply_markup(reply_markup=None)
+            await send_messages_file(query.message, get_pool(context), user_username)
+            return
+        text, last_id, has_more = await load_messages_page(get_pool(context), user_username, int(action))
+        if not text:
+            await query.edit_message_reply_markup(reply_markup=None)
+            return
+        # Предыдущую страницу оставляем в чате, следующую присылаем новым сообщением
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text(text, reply_markup=messages_page_keyboard(last_id, has_more))
+    except Exception as e:
+        logging.error(f"Произошла ошибка:{e}")
+        await query.message.reply_text(f'Ошибка:{e}')
 
-        await update.message.reply_text(decoded_results)
-        await update.message.reply_text(formatted_results)
+# Массовые операции над сообщениями пользователя идут пачками по MESSAGES_BULK_BATCH_SIZE строк, каждая в своей транзакции,
+#чтобы не держать блокировки на всю историю сразу. Пачка выбирается по индексу messages_username_id_idx после последнего обработанного id
+#и не дальше максимального id на момент начала операции (сообщения, пришедшие во время операции, не затрагиваются).
+#Запрос возвращает количество обработанных строк и последний id пачки
+DELETE_MESSAGES_BATCH_QUERY = """
+    WITH batch AS (
+        SELECT id FROM messages
+        WHERE username = %(username)s AND id > %(after_id)s AND id <= %(max_id)s
+        ORDER BY id
+        LIMIT %(limit)s
+    ), done AS (
+        DELETE FROM messages m USING batch WHERE m.id = batch.id
+        RETURNING m.id
+    )
+    SELECT COUNT(*), MAX(id) FROM done;
+"""
 
-        conn.commit()
-        cursor.close()
-        conn.close()
-    except Exception as e:
-        print(f'Ошибка:{e}')
-        await update.message.reply_text(f'Ошибка:{e}')
+UPDATE_MESSAGES_BATCH_QUERY = """
+    WITH batch AS (
+        SELECT id FROM messages
+        WHERE username = %(username)s AND id > %(after_id)s AND id <= %(max_id)s
+        ORDER BY id
+        LIMIT %(limit)s
+    ), done AS (
+        UPDATE messages m SET text = m.text || ')' FROM batch WHERE m.id = batch.id
+        RETURNING m.id
+    )
+    SELECT COUNT(*), MAX(id) FROM done;
+"""
+
+async def run_messages_batches(pool: AsyncConnectionPool, query: str, username: str) -> tuple:
+    """
+    Функция выполняет пакетный запрос над сообщениями пользователя, пока не обработает все. Возвращает (количество строк, секунды)
+    """
+    started = time.perf_counter()
+    total = 0
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT MAX(id) FROM messages WHERE username = %s;", (username,))
+            max_id = (await cursor.fetchone())[0]
+            await conn.commit()
+            after_id = 0
+            while max_id is not None and after_id < max_id:
+                await cursor.execute(query, {"username": username, "after_id": after_id, "max_id": max_id,
+                                             "limit": MESSAGES_BULK_BATCH_SIZE})
+                count, last_id = await cursor.fetchone()
+                await conn.commit() # каждая пачка - отдельная короткая транзакция
+                if count == 0:
+                    break
+                total += count
+                after_id = last_id
+    return total, time.perf_counter() - started
 
 async def delete_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -456,17 +2386,12 @@ async def delete_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_username = update.message.from_user.username
 
     try:
-        conn=psycopg2.connect(URL)
-        cursor=conn.cursor()
-        cursor.execute(f"DELETE from messages where username = '{user_username}';")
-        await update.message.reply_text("Deleted все удалено")
+        deleted, elapsed = await run_messages_batches(get_pool(context), DELETE_MESSAGES_BATCH_QUERY, user_username)
+        await update.message.reply_text(f"Deleted все удалено: {deleted} сообщений за {elapsed:.2f} с")
 #В вашей функции выполняется только запрос на удаление записей из таблицы messages. 
 # Однако, запрос на удаление не затрагивает таблицу message_updates/ то есть там можно отследить всю историю всех записей
-        conn.commit()
-        cursor.close()
-        conn.close()
     except Exception as e:
-        print(f'Ошибка:{e}')
+        logging.error(f"Произошла ошибка:{e}")
         await update.message.reply_text(f'Ошибка:{e}')
 
 async def update_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -476,39 +2401,127 @@ async def update_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_username = update.message.from_user.username
 
     try:
-        conn=psycopg2.connect(URL)
-        cursor=conn.cursor()
-        cursor.execute(f"UPDATE messages SET text = text || ')' where username = '{user_username}';")
-        await update.message.reply_text("Updated")
-
-        conn.commit()
-        cursor.close()
-        conn.close()
+        updated, elapsed = await run_messages_batches(get_pool(context), UPDATE_MESSAGES_BATCH_QUERY, user_username)
+        await update.message.reply_text(f"Updated: {updated} сообщений за {elapsed:.2f} с")
     except Exception as e:
-        print(f'Ошибка:{e}')
+        logging.error(f"Произошла ошибка:{e}")
         await update.message.reply_text(f'Ошибка:{e}')
+
+@authorize
+async def metrics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Функция показывает метрики обработчиков: количество вызовов и ошибок, задержки и их разбивку на api, db и render
+    """
+    await update.message.reply_text(f"{METRICS.summary()}\n\nПул БД: {pool_stats(get_pool(context))}")
  
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Одновременная обработка обновлений: обновления разных чатов обрабатываются параллельно (не больше max_concurrent_updates сразу),
+    а обновления одного чата - по очереди, в порядке поступления.
+    Семафор базового класса ограничивает все принятые обновления (max_pending_updates), включая ждущие своей очереди в чате,
+    поэтому несколько сообщений подряд из одного чата не занимают места обработки других чатов
+    """
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.workers = asyncio.Semaphore(max_concurrent_updates)
+        self.chats = {} # id чата -> [asyncio.Lock, сколько обновлений чата принято]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self.workers:
+                await coroutine
+            return
+        entry = self.chats.get(chat.id)
+        if entry is None:
+            entry = self.chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chats[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 def main():
 
     init_db()#инициализирует базу данных, создавая необходимые таблицы. 
     #Это выполняется до запуска бота, чтобы база данных была подготовлена.
 
-    #Создание и настройка бота:
-    application = ApplicationBuilder().token(TOKEN).build()
-    #Добавление обработчиков команд:
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("return_all_messages", return_all_messages))
-    application.add_handler(CommandHandler("delete_all_messages", delete_all_messages))
-    application.add_handler(CommandHandler("update_all_messages", update_all_messages))
-    application.add_handler(CommandHandler("get_historical_rates", get_historical_rates))
-    application.add_handler(CommandHandler("get_rates", get_rates))
-    application.add_handler(CommandHandler("plot", plot))
+    #Создание и настройка бота. Общие ресурсы открываются после старта цикла событий (post_init) и закрываются при остановке (post_shutdown)
+    builder = ApplicationBuilder().token(TOKEN).base_url(TELEGRAM_API_URL).post_init(on_startup).post_shutdown(on_shutdown)
+    if CONCURRENT_UPDATES > 1:
+        #Медленная команда одного пользователя не задерживает остальных; сообщения одного чата обрабатываются по порядку
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES, UPDATES_QUEUE_SIZE))
+    application = builder.build()
+    #Общий асинхронный пул соединений с базой данных, доступен обработчикам через context.bot_data["db_pool"]
+    application.bot_data["db_pool"] = AsyncConnectionPool(URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, open=False,
+                                                           configure=configure_connection)
+    #Очередь пакетной записи сообщений из echo; запускается в on_startup, остаток дописывается в on_shutdown
+    application.bot_data["message_writer"] = MessageLogWriter(application.bot_data["db_pool"], MESSAGE_BATCH_SIZE,
+                                                              MESSAGE_FLUSH_INTERVAL, MESSAGE_QUEUE_SIZE,
+                                                              MESSAGE_FLUSH_RETRIES, MESSAGE_RETRY_DELAY)
+    #Обновление кэшей, когда курсы записывает другой экземпляр бота; запускается в on_startup
+    application.bot_data["rates_subscriber"] = RatesStoredSubscriber(URL, application.bot_data["db_pool"])
+    #Общий клиент API курсов валют (пул соединений и ограничение частоты запросов на всё приложение)
+    rates_api = ExchangeRatesClient(API_KEY, API_URL, API_TIMEOUT, API_CONNECT_TIMEOUT, API_MAX_CONNECTIONS, API_HTTP2,
+                                    TokenBucket(API_RATE_LIMIT, API_RATE_BURST))
+    application.bot_data["rates_api"] = rates_api
+    #Кэш последних курсов для /get_rates, общий для всех пользователей
+    application.bot_data["rates_cache"] = LatestRatesCache(rates_api, RATES_CACHE_TTL)
+    #Пул процессов для рисования графиков /plot. Процессы запускаются через spawn, а не fork: к этому моменту в процессе
+    #уже работают потоки (httpx, psycopg, to_thread), и копия их блокировок в дочернем процессе может навсегда остаться занятой
+    application.bot_data["plot_executor"] = ProcessPoolExecutor(max_workers=PLOT_WORKERS,
+                                                                mp_context=multiprocessing.get_context("spawn"))
+    #Кэш готовых графиков; сбрасывается для валют, по которым store_rates записал новые курсы
+    chart_cache = ChartCache(CHART_CACHE_MAX_BYTES)
+    application.bot_data["chart_cache"] = chart_cache
+    RATES_STORED_LISTENERS.append(chart_cache.invalidate)
+    #Матрица курсов в памяти для кросс-курсов (/convert, /plot EUR/JPY); загружается при первом обращении
+    rate_matrix = RateMatrix()
+    application.bot_data["rate_matrix"] = rate_matrix
+    RATES_STORED_LISTENERS.append(rate_matrix.update)
+    #Добавление обработчиков команд. Каждый обработчик обёрнут в measure: время выполнения и ошибки попадают в метрики
+    application.add_handler(CommandHandler("start", measure(start)))
+    application.add_handler(CommandHandler("return_all_messages", measure(return_all_messages)))
+    application.add_handler(CallbackQueryHandler(measure(messages_page), pattern=r"^messages:"))
+    application.add_handler(CommandHandler("delete_all_messages", measure(delete_all_messages)))
+    application.add_handler(CommandHandler("update_all_messages", measure(update_all_messages)))
+    #Долгие команды выполняются в фоне (block=False): пока они работают, следующие сообщения этого чата обрабатываются, не дожидаясь их
+    application.add_handler(CommandHandler("get_historical_rates", measure(get_historical_rates), block=False))
+    application.add_handler(CommandHandler("get_rates", measure(get_rates)))
+    application.add_handler(CommandHandler("plot", measure(plot), block=False))
+    application.add_handler(CommandHandler("stats", measure(stats)))
+    application.add_handler(CommandHandler("convert", measure(convert)))
+    application.add_handler(CommandHandler("export", measure(export), block=False))
+    application.add_handler(CommandHandler("metrics", measure(metrics)))
+    #Фоновая загрузка курсов: сразу после запуска догружаем пропущенные дни, затем регулярно обновляем последние курсы
+    if INGEST_INTERVAL > 0:
+        application.job_queue.run_once(measure(catch_up_job), when=0)
+        application.job_queue.run_repeating(measure(ingest_job), interval=INGEST_INTERVAL, first=INGEST_INTERVAL)
     #Добавление обработчика для текстовых сообщений:
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo)) #Этот обработчик реагирует на все текстовые сообщения, 
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, measure(echo))) #Этот обработчик реагирует на все текстовые сообщения, 
     #которые не являются командами (например, /start)
-    #Запуск бота. Бот начинает слушать входящие обновления с помощью метода run_polling().
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    #Запуск бота. Если задан WEBHOOK_URL, Telegram присылает обновления на локальный HTTP-сервер (за ним может стоять несколько
+    #экземпляров бота за одним балансировщиком), иначе бот сам запрашивает их методом run_polling()
+    if WEBHOOK_URL:
+        application.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                                allowed_updates=Update.ALL_TYPES)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 #Запуск основной функции при старте программы
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        cli(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,252 @@
+"""
+Нагрузочный тест бота в режиме вебхука.
+
+Скрипт запускает бота (один или несколько экземпляров) с вебхуком на localhost, сам изображает Telegram Bot API
+(бот отправляет ответы ему, а не в Telegram) и присылает боту синтетические обновления - так же, как это делает Telegram.
+Каждый чат - виртуальный пользователь: отправляет сообщение, ждёт все ответы бота и отправляет следующее.
+В конце печатает количество обновлений в секунду и задержки (p50/p95/p99) от отправки обновления до последнего ответа бота.
+
+    python loadtest.py --updates 2000 --chats 50
+    python loadtest.py --replicas 2 --text "/start" --text "/convert 100 EUR JPY"
+
+Бот работает с базой из DATABASE_URL. Уже запущенные экземпляры (например, за балансировщиком) можно проверить так:
+запустить их с TELEGRAM_API_URL=http://<этот компьютер>:8081/bot и передать адрес вебхука в --webhook-url.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+from urllib.parse import parse_qs
+
+import httpx
+
+DEFAULT_TEXTS = ["/start", "/convert 100 EUR JPY", "/stats EUR", "Привет"] # команды и текст, которые отправляют пользователи
+TOKEN = "123456:loadtest"
+SECRET = "loadtest"
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+class FakeBotAPI:
+    """
+    Заглушка Telegram Bot API: отвечает на запросы бота и считает ответы (send*) в каждый чат.
+    Редактирование сообщений (индикаторы прогресса) ответом не считается. delay - задержка ответа (сек), как у настоящего Bot API по сети
+    """
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.message_ids = itertools.count(1)
+        self.waiters = {} # id чата -> [сколько ещё ответов ждём, future]
+        self.replies = {} # id чата -> количество ответов (для калибровки)
+        self.strays = 0 # ответы, которых никто не ждал
+        self.webhooks = 0 # сколько экземпляров бота установили вебхук
+
+    def expect(self, chat_id: int, replies: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = [replies, future]
+        return future
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True: # соединения keep-alive: несколько запросов подряд
+                line = await reader.readline()
+                if not line:
+                    break
+                path = line.split()[1].decode()
+                headers = {}
+                while (header := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = header.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                result = self.call(path.rsplit("/", 1)[-1], self.params(headers.get("content-type", ""), body))
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                data = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(data) + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def params(content_type: str, body: bytes) -> dict:
+        if "json" in content_type:
+            return json.loads(body or b"{}")
+        if "multipart" in content_type: # файлы (графики, выгрузки): нужны только простые поля
+            return {name.decode(): value.decode(errors="replace") for name, value in re.findall(rb'name="(\w+)"\r\n\r\n([^\r]*)', body)}
+        return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    def call(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": int(TOKEN.split(":")[0]), "is_bot": True, "first_name": "Load test", "username": "loadtest_bot"}
+        if method == "setWebhook":
+            self.webhooks += 1
+            return True
+        if not (method.startswith("send") or method.startswith("edit")):
+            return True
+        chat_id = int(params.get("chat_id", 0))
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                   "text": params.get("text", "")}
+        if method == "sendPhoto":
+            message["photo"] = [{"file_id": f"photo{message['message_id']}", "file_unique_id": "photo", "width": 1, "height": 1}]
+        if method == "sendDocument":
+            message["document"] = {"file_id": f"document{message['message_id']}", "file_unique_id": "document"}
+        if method.startswith("send"):
+            self.replies[chat_id] = self.replies.get(chat_id, 0) + 1
+            waiter = self.waiters.get(chat_id)
+            if waiter is None:
+                self.strays += 1
+            else:
+                waiter[0] -= 1
+                if not waiter[0]:
+                    del self.waiters[chat_id]
+                    waiter[1].set_result(time.perf_counter())
+        return message
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Load", "username": f"load{chat_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+async def wait_for_replies(api: FakeBotAPI, chat_id: int, quiet: float, timeout: float) -> int:
+    """
+    Функция ждёт первый ответ бота в чат, затем - пока бот перестанет отвечать (нет ответов quiet секунд), и возвращает количество ответов
+    """
+    deadline = time.monotonic() + timeout
+    while not api.replies.get(chat_id) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    count = -1
+    while count != api.replies.get(chat_id, 0) and time.monotonic() < deadline:
+        count = api.replies.get(chat_id, 0)
+        await asyncio.sleep(quiet)
+    return count
+
+async def run(args) -> None:
+    api = FakeBotAPI(args.api_delay)
+    server = await asyncio.start_server(api.handle, "0.0.0.0", args.api_port)
+    processes = []
+    if args.webhook_url:
+        urls = args.webhook_url
+    else:
+        # Экземпляры бота слушают вебхук на соседних портах; скрипт сам распределяет обновления между ними, как балансировщик
+        urls = []
+        for replica in range(args.replicas):
+            port = args.port + replica
+            env = dict(os.environ, BOT_TOKEN=TOKEN, TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}/bot",
+                       WEBHOOK_URL=f"http://127.0.0.1:{port}", WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(port),
+                       WEBHOOK_SECRET=SECRET)
+            env.setdefault("INGEST_INTERVAL", "0")
+            env["METRICS_PORT"] = str(int(env["METRICS_PORT"]) + replica) if env.get("METRICS_PORT") else "0"
+            processes.append(subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")],
+                                              env=env, stdout=None if args.verbose else subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL))
+            urls.append(f"http://127.0.0.1:{port}/telegram")
+    try:
+        async with httpx.AsyncClient(timeout=args.timeout, limits=httpx.Limits(max_connections=args.chats + 1),
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as client:
+            update_ids = itertools.count(1)
+
+            async def post(chat_id: int, text: str) -> None:
+                update_id = next(update_ids)
+                response = await client.post(urls[update_id % len(urls)], json=make_update(update_id, chat_id, text))
+                response.raise_for_status()
+
+            # Ждём, пока все экземпляры бота запустятся и начнут принимать вебхуки
+            deadline = time.monotonic() + args.timeout
+            while processes and api.webhooks < len(processes):
+                if time.monotonic() > deadline or any(process.poll() is not None for process in processes):
+                    raise SystemExit("Бот не запустился (запустите с --verbose, чтобы увидеть его лог)")
+                await asyncio.sleep(0.2)
+            for url in urls:
+                while True:
+                    try:
+                        await client.get(url)
+                        break
+                    except httpx.TransportError:
+                        if time.monotonic() > deadline:
+                            raise
+                        await asyncio.sleep(0.2)
+
+            # Калибровка: сколько ответов бот отправляет на каждый текст (заодно прогреваются кэши бота)
+            replies = {}
+            for i, text in enumerate(dict.fromkeys(args.text)):
+                chat_id = 10**9 + i
+                await post(chat_id, text)
+                replies[text] = await wait_for_replies(api, chat_id, args.quiet, args.timeout)
+                if not replies[text]:
+                    raise SystemExit(f"Бот не ответил на {text!r}")
+            print("Ответов на обновление:", ", ".join(f"{text!r}: {count}" for text, count in replies.items()))
+            api.strays = 0
+
+            latencies = {text: [] for text in replies}
+            errors = 0
+            sent = itertools.count()
+
+            async def user(chat_id: int) -> None:
+                nonlocal errors
+                while (n := next(sent)) < args.updates:
+                    text = args.text[n % len(args.text)]
+                    done = api.expect(chat_id, replies[text])
+                    started = time.perf_counter()
+                    try:
+                        await post(chat_id, text)
+                        latencies[text].append(await asyncio.wait_for(done, args.timeout) - started)
+                    except (httpx.HTTPError, asyncio.TimeoutError):
+                        api.waiters.pop(chat_id, None)
+                        errors += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(user(chat_id) for chat_id in range(1, args.chats + 1)))
+            elapsed = time.perf_counter() - started
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            try:
+                await asyncio.to_thread(process.wait, 30) # пока бот останавливается, заглушка Bot API продолжает ему отвечать
+            except subprocess.TimeoutExpired:
+                process.kill()
+        await asyncio.sleep(0.1) # соединения остановленных ботов закрываются
+        server.close()
+        await server.wait_closed()
+
+    done = [latency for values in latencies.values() for latency in values]
+    print(f"Экземпляров бота: {len(urls)}, чатов: {args.chats}, обновлений: {len(done)} за {elapsed:.2f} с, ошибок: {errors}, лишних ответов: {api.strays}")
+    print(f"Пропускная способность: {len(done) / elapsed:.1f} обновлений/с")
+    print(f"Задержка: p50 {percentile(done, 0.5) * 1000:.1f} мс, p95 {percentile(done, 0.95) * 1000:.1f} мс, "
+          f"p99 {percentile(done, 0.99) * 1000:.1f} мс, максимум {max(done, default=0) * 1000:.1f} мс")
+    for text, values in latencies.items():
+        print(f"  {text!r}: {len(values)} шт., p50 {percentile(values, 0.5) * 1000:.1f} мс, p99 {percentile(values, 0.99) * 1000:.1f} мс")
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота в режиме вебхука")
+    parser.add_argument("--updates", type=int, default=1000, help="сколько обновлений отправить")
+    parser.add_argument("--chats", type=int, default=50, help="сколько пользователей отправляют сообщения одновременно")
+    parser.add_argument("--text", action="append", help="текст сообщения (можно несколько раз); по умолчанию - смесь команд")
+    parser.add_argument("--replicas", type=int, default=1, help="сколько экземпляров бота запустить")
+    parser.add_argument("--port", type=int, default=8443, help="порт вебхука первого экземпляра")
+    parser.add_argument("--api-port", type=int, default=8081, help="порт заглушки Bot API")
+    parser.add_argument("--webhook-url", action="append", help="адрес вебхука уже запущенного бота (тогда бот не запускается)")
+    parser.add_argument("--api-delay", type=float, default=0.05, help="задержка ответа заглушки Bot API (сек)")
+    parser.add_argument("--timeout", type=float, default=60, help="сколько ждать ответа бота (сек)")
+    parser.add_argument("--quiet", type=float, default=1, help="пауза без ответов, после которой калибровка считает ответ законченным (сек)")
+    parser.add_argument("--verbose", action="store_true", help="показывать лог бота")
+    args = parser.parse_args(argv)
+    args.text = args.text or DEFAULT_TEXTS
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()